@@ -1,6 +1,6 @@
 import os
 
-from langchain_community.graphs import Neo4jGraph
+from neo4j_factory import get_graph, pool_metrics
 from dotenv import load_dotenv
 from utils import (
     create_vector_index,
@@ -12,16 +12,21 @@ from chains import (
     configure_llm_only_chain,
     configure_qa_rag_chain,
     generate_ticket,
+    SemanticAnswerCache,
+    ollama_timings,
 )
 from fastapi import FastAPI, Depends
 from pydantic import BaseModel
-from langchain.callbacks.base import BaseCallbackHandler
-from threading import Thread
-from queue import Queue, Empty
-from collections.abc import Generator
+from langchain.callbacks.base import AsyncCallbackHandler
+from collections.abc import AsyncGenerator
 from sse_starlette.sse import EventSourceResponse
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+import asyncio
 import json
+import re
 
 load_dotenv(".env")
 
@@ -29,66 +34,143 @@ url = os.getenv("NEO4J_URI")
 username = os.getenv("NEO4J_USERNAME")
 password = os.getenv("NEO4J_PASSWORD")
 ollama_base_url = os.getenv("OLLAMA_BASE_URL")
+ollama_keep_alive = os.getenv("OLLAMA_KEEP_ALIVE")
 embedding_model_name = os.getenv("EMBEDDING_MODEL")
 llm_name = os.getenv("LLM")
+# Generations running at once, further requests wait for a free slot
+max_concurrent_generations = int(os.getenv("API_MAX_CONCURRENT_GENERATIONS", "8"))
+semantic_cache_threshold = os.getenv("SEMANTIC_CACHE_THRESHOLD")
+query_batch_size = os.getenv("EMBEDDING_QUERY_BATCH_SIZE")
+query_batch_wait_ms = os.getenv("EMBEDDING_QUERY_BATCH_WAIT_MS")
+# Vector + full-text retrieval fused with reciprocal rank fusion
+rag_config = {
+    "hybrid_search": os.getenv("RAG_HYBRID_SEARCH", "false").lower() == "true",
+    "vector_weight": os.getenv("RAG_VECTOR_WEIGHT"),
+    "fulltext_weight": os.getenv("RAG_FULLTEXT_WEIGHT"),
+    "vector_timeout_ms": os.getenv("RAG_VECTOR_TIMEOUT_MS"),
+    "fulltext_timeout_ms": os.getenv("RAG_FULLTEXT_TIMEOUT_MS"),
+}
 # Remapping for Langchain Neo4j integration
 os.environ["NEO4J_URL"] = url
 
-embeddings, dimension = load_embedding_model(
-    embedding_model_name,
-    config={"ollama_base_url": ollama_base_url},
-    logger=BaseLogger(),
-)
+# LLM calls can take tens of seconds: they are awaited or run in this bounded
+# executor so they never block the event loop serving other requests
+generation_slots = asyncio.Semaphore(max_concurrent_generations)
+executor = ThreadPoolExecutor(max_workers=max_concurrent_generations)
+
+# The embedding model, LLM client and chains are slow to build (torch, model
+# downloads, Neo4j round trips). They are built in the background once the
+# server is up, /ready reports when they are available.
+embeddings = dimension = neo4j_graph = llm = None
+llm_chain = allm_chain = rag_chain = answer_cache = None
+warm_up_task = None
+
+
+def warm_up() -> None:
+    global embeddings, dimension, neo4j_graph, llm
+    global llm_chain, allm_chain, rag_chain, answer_cache
+
+    embeddings, dimension = load_embedding_model(
+        embedding_model_name,
+        config={
+            "ollama_base_url": ollama_base_url,
+            "query_batch_size": query_batch_size,
+            "query_batch_wait_ms": query_batch_wait_ms,
+        },
+        logger=BaseLogger(),
+    )
 
-# if Neo4j is local, you can go to http://localhost:7474/ to browse the database
-neo4j_graph = Neo4jGraph(url=url, username=username, password=password)
-create_vector_index(neo4j_graph, dimension)
+    # if Neo4j is local, you can go to http://localhost:7474/ to browse the database
+    neo4j_graph = get_graph(url, username, password)
+    create_vector_index(neo4j_graph, dimension)
 
-llm = load_llm(
-    llm_name, logger=BaseLogger(), config={"ollama_base_url": ollama_base_url}
-)
+    llm = load_llm(
+        llm_name,
+        logger=BaseLogger(),
+        config={"ollama_base_url": ollama_base_url, "ollama_keep_alive": ollama_keep_alive},
+    )
 
-llm_chain = configure_llm_only_chain(llm)
-rag_chain = configure_qa_rag_chain(
-    llm, embeddings, embeddings_store_url=url, username=username, password=password
-)
+    llm_chain = configure_llm_only_chain(llm)
+    allm_chain = configure_llm_only_chain(llm, use_async=True)
+    rag_chain = configure_qa_rag_chain(
+        llm,
+        embeddings,
+        embeddings_store_url=url,
+        username=username,
+        password=password,
+        config=rag_config,
+    )
 
+    # Near-identical RAG questions are answered from the semantic cache when enabled
+    if semantic_cache_threshold:
+        answer_cache = SemanticAnswerCache(
+            neo4j_graph,
+            embeddings,
+            dimension,
+            threshold=float(semantic_cache_threshold),
+            ttl_seconds=int(os.getenv("SEMANTIC_CACHE_TTL_SECONDS", "86400")),
+            max_entries=int(os.getenv("SEMANTIC_CACHE_MAX_ENTRIES", "10000")),
+        )
 
-class QueueCallback(BaseCallbackHandler):
-    """Callback handler for streaming LLM responses to a queue."""
 
-    def __init__(self, q):
-        self.q = q
+async def ensure_warm() -> None:
+    # Requests arriving during warm up wait for it, a failed warm up is raised
+    await asyncio.shield(warm_up_task)
 
-    def on_llm_new_token(self, token: str, **kwargs) -> None:
-        self.q.put(token)
 
-    def on_llm_end(self, *args, **kwargs) -> None:
-        return self.q.empty()
+async def cached_answer(question: str):
+    if answer_cache is None:
+        return None
+    # Short Neo4j round trips, on the default executor so they never queue
+    # behind ticket generations in the generation executor
+    return await asyncio.get_running_loop().run_in_executor(
+        None, answer_cache.get, question
+    )
 
 
-def stream(cb, q) -> Generator:
-    job_done = object()
+async def cache_answer(question: str, result: dict) -> None:
+    if answer_cache is not None:
+        await asyncio.get_running_loop().run_in_executor(
+            None, answer_cache.put, question, result
+        )
+
+
+class AsyncQueueCallback(AsyncCallbackHandler):
+    """Callback handler for streaming LLM responses to an asyncio queue."""
 
-    def task():
-        x = cb()
-        q.put(job_done)
+    def __init__(self, q: asyncio.Queue):
+        self.q = q
+        # Models without native async (e.g. BedrockChat) run in an executor thread
+        # with an event loop of their own, so tokens are handed to the server loop
+        self.loop = asyncio.get_running_loop()
+
+    async def on_llm_new_token(self, token: str, **kwargs) -> None:
+        self.loop.call_soon_threadsafe(self.q.put_nowait, token)
 
-    t = Thread(target=task)
-    t.start()
 
-    content = ""
+async def stream(cb, q: asyncio.Queue) -> AsyncGenerator:
+    job_done = object()
+    loop = asyncio.get_running_loop()
 
-    # Get each new token from the queue and yield for our generator
-    while True:
+    async def task():
         try:
-            next_token = q.get(True, timeout=1)
+            await cb()
+        finally:
+            # Queued behind any tokens still being handed over from other threads
+            loop.call_soon_threadsafe(q.put_nowait, job_done)
+
+    t = asyncio.create_task(task())
+    try:
+        # Get each new token from the queue and yield for our generator
+        while True:
+            next_token = await q.get()
             if next_token is job_done:
                 break
-            content += next_token
-            yield next_token, content
-        except Empty:
-            continue
+            yield next_token
+        await t
+    finally:
+        # Client went away before the answer was complete
+        t.cancel()
 
 
 app = FastAPI()
@@ -103,11 +185,43 @@ app.add_middleware(
 )
 
 
+@app.on_event("startup")
+async def start_warm_up():
+    global warm_up_task
+    warm_up_task = asyncio.get_running_loop().run_in_executor(None, warm_up)
+
+
 @app.get("/")
 async def root():
     return {"message": "Hello World"}
 
 
+@app.get("/ready")
+async def ready():
+    if not warm_up_task.done():
+        return JSONResponse({"ready": False}, status_code=503)
+    if warm_up_task.exception() is not None:
+        return JSONResponse(
+            {"ready": False, "error": str(warm_up_task.exception())}, status_code=503
+        )
+    return {"ready": True}
+
+
+@app.get("/pool-metrics")
+async def neo4j_pool_metrics():
+    return pool_metrics()
+
+
+@app.get("/llm-metrics")
+async def llm_metrics():
+    # Prompt evaluation vs generation time of recent Ollama requests, and the
+    # load of each server when several are configured
+    metrics = ollama_timings.stats()
+    if hasattr(llm, "stats"):
+        metrics["backends"] = llm.stats()
+    return metrics
+
+
 class Question(BaseModel):
     text: str
     rag: bool = False
@@ -118,22 +232,34 @@ class BaseTicket(BaseModel):
 
 
 @app.get("/query-stream")
-def qstream(question: Question = Depends()):
-    output_function = llm_chain
-    if question.rag:
-        output_function = rag_chain
-
-    q = Queue()
-
-    def cb():
-        output_function(
-            {"question": question.text, "chat_history": []},
-            callbacks=[QueueCallback(q)],
-        )
-
-    def generate():
+async def qstream(question: Question = Depends()):
+    await ensure_warm()
+    q = asyncio.Queue()
+
+    async def cb():
+        inputs = {"question": question.text, "chat_history": []}
+        callbacks = [AsyncQueueCallback(q)]
+        if question.rag:
+            cached = await cached_answer(question.text)
+            if cached:
+                # Replay the stored answer and sources in the same token event format
+                for token in re.findall(
+                    r"\s*\S+", SemanticAnswerCache.streamed_text(cached)
+                ):
+                    await q.put(token)
+                return
+        async with generation_slots:
+            if question.rag:
+                result = await rag_chain.ainvoke(
+                    inputs, config={"callbacks": callbacks}
+                )
+                await cache_answer(question.text, result)
+            else:
+                await allm_chain(inputs, callbacks=callbacks)
+
+    async def generate():
         yield json.dumps({"init": True, "model": llm_name})
-        for token, _ in stream(cb, q):
+        async for token in stream(cb, q):
             yield json.dumps({"token": token})
 
     return EventSourceResponse(generate(), media_type="text/event-stream")
@@ -141,21 +267,33 @@ def qstream(question: Question = Depends()):
 
 @app.get("/query")
 async def ask(question: Question = Depends()):
-    output_function = llm_chain
+    await ensure_warm()
+    inputs = {"question": question.text, "chat_history": []}
     if question.rag:
-        output_function = rag_chain
-    result = output_function(
-        {"question": question.text, "chat_history": []}, callbacks=[]
-    )
+        cached = await cached_answer(question.text)
+        if cached:
+            return {"result": cached["answer"], "model": llm_name}
+    async with generation_slots:
+        if question.rag:
+            result = await rag_chain.ainvoke(inputs)
+            await cache_answer(question.text, result)
+        else:
+            result = await allm_chain(inputs, callbacks=[])
 
     return {"result": result["answer"], "model": llm_name}
 
 
 @app.get("/generate-ticket")
 async def generate_ticket_api(question: BaseTicket = Depends()):
-    new_title, new_question = generate_ticket(
-        neo4j_graph=neo4j_graph,
-        llm_chain=llm_chain,
-        input_question=question.text,
-    )
+    await ensure_warm()
+    async with generation_slots:
+        new_title, new_question = await asyncio.get_running_loop().run_in_executor(
+            executor,
+            partial(
+                generate_ticket,
+                neo4j_graph=neo4j_graph,
+                llm_chain=llm_chain,
+                input_question=question.text,
+            ),
+        )
     return {"result": {"title": new_title, "text": new_question}, "model": llm_name}
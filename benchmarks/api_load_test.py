@@ -0,0 +1,85 @@
+"""Check that long generations don't block the API's event loop.
+
+Measures the latency of a cheap endpoint (`/` by default) on its own, then again
+while a number of long `/query` generations are in flight, and compares p50/p99.
+
+    python benchmarks/api_load_test.py --url http://localhost:8504 --generations 8
+
+Exits with status 1 if the p99 latency under load exceeds --max-p99-ms.
+"""
+import argparse
+import statistics
+import sys
+import time
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+
+def get(url: str, timeout: float = 600) -> float:
+    started = time.perf_counter()
+    with urllib.request.urlopen(url, timeout=timeout) as response:
+        response.read()
+    return (time.perf_counter() - started) * 1000
+
+
+def percentiles(samples: list) -> dict:
+    quantiles = statistics.quantiles(samples, n=100, method="inclusive")
+    return {"p50": quantiles[49], "p95": quantiles[94], "p99": quantiles[98]}
+
+
+def probe(url: str, count: int, interval: float) -> list:
+    samples = []
+    for _ in range(count):
+        samples.append(get(url, timeout=60))
+        time.sleep(interval)
+    return samples
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--url", default="http://localhost:8504")
+    parser.add_argument("--probe-path", default="/")
+    parser.add_argument("--generations", type=int, default=8)
+    parser.add_argument("--question", default="How do I create a vector index in Neo4j?")
+    parser.add_argument("--rag", action="store_true")
+    parser.add_argument("--probes", type=int, default=200)
+    parser.add_argument("--interval", type=float, default=0.05)
+    parser.add_argument("--max-p99-ms", type=float, default=250.0)
+    args = parser.parse_args()
+
+    probe_url = args.url.rstrip("/") + args.probe_path
+    query_url = (
+        args.url.rstrip("/")
+        + "/query?"
+        + urllib.parse.urlencode({"text": args.question, "rag": str(args.rag).lower()})
+    )
+
+    baseline = percentiles(probe(probe_url, args.probes, args.interval))
+    print(f"idle      {probe_url}: " + " ".join(f"{k}={v:.1f}ms" for k, v in baseline.items()))
+
+    with ThreadPoolExecutor(max_workers=args.generations) as pool:
+        generations = [pool.submit(get, query_url) for _ in range(args.generations)]
+        # Give the generations a moment to reach the LLM before probing
+        time.sleep(1)
+        loaded_samples = probe(probe_url, args.probes, args.interval)
+        in_flight = sum(not g.done() for g in generations)
+        durations = [g.result() for g in generations]
+
+    loaded = percentiles(loaded_samples)
+    print(f"loaded    {probe_url}: " + " ".join(f"{k}={v:.1f}ms" for k, v in loaded.items()))
+    print(
+        f"generations: {len(durations)}, still running after probing: {in_flight}, "
+        f"median duration {statistics.median(durations) / 1000:.1f}s"
+    )
+    if in_flight == 0:
+        print("warning: generations finished before probing ended, raise --generations or --question length")
+    if loaded["p99"] > args.max_p99_ms:
+        print(f"FAIL: p99 {loaded['p99']:.1f}ms under load exceeds {args.max_p99_ms}ms")
+        return 1
+    print("OK")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
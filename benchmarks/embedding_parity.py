@@ -0,0 +1,93 @@
+"""Compare the ONNX Runtime embedding backends with eager SentenceTransformer.
+
+Embeds the same texts with each backend, checks that the vectors have the same
+dimension and agree within tolerance, and reports texts/second:
+
+    python benchmarks/embedding_parity.py --cache-folder ./embedding_model
+
+fp32 ONNX must match element-wise within --fp32-atol, int8 must keep a cosine
+similarity of at least --int8-min-cosine. Exits with status 1 otherwise.
+"""
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from onnx_embeddings import OnnxSentenceEmbeddings
+
+TEXTS = [
+    "How do I create a unique constraint in Neo4j?",
+    "Cypher MERGE creates duplicate nodes when run concurrently",
+    "What is the difference between a relationship index and a node index?",
+    "py2neo connection refused on bolt://localhost:7687",
+    "APOC procedure not found after upgrading to 5.x",
+    "",
+    "x" * 5000,
+]
+
+
+def timed(embed, texts: list, runs: int) -> tuple:
+    vectors = np.array(embed(texts))
+    started = time.perf_counter()
+    for _ in range(runs):
+        embed(texts)
+    return vectors, len(texts) * runs / (time.perf_counter() - started)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--cache-folder", default="/embedding_model")
+    parser.add_argument("--runs", type=int, default=20)
+    parser.add_argument("--fp32-atol", type=float, default=1e-4)
+    parser.add_argument("--int8-min-cosine", type=float, default=0.98)
+    args = parser.parse_args()
+
+    from langchain_community.embeddings.sentence_transformer import (
+        SentenceTransformerEmbeddings,
+    )
+
+    texts = TEXTS * 8
+    reference, reference_rate = timed(
+        SentenceTransformerEmbeddings(
+            model_name="all-MiniLM-L6-v2", cache_folder=args.cache_folder
+        ).embed_documents,
+        texts,
+        args.runs,
+    )
+    print(f"sentence_transformer: {reference.shape[1]} dims, {reference_rate:.0f} texts/s")
+
+    failed = False
+    for quantize in (False, True):
+        name = "sentence_transformer_int8" if quantize else "sentence_transformer_onnx"
+        vectors, rate = timed(
+            OnnxSentenceEmbeddings(
+                cache_folder=args.cache_folder, quantize=quantize
+            ).embed_documents,
+            texts,
+            args.runs,
+        )
+        if vectors.shape != reference.shape:
+            print(f"{name}: shape {vectors.shape} != {reference.shape} FAILED")
+            failed = True
+            continue
+        max_diff = float(np.abs(vectors - reference).max())
+        min_cosine = float((vectors * reference).sum(axis=1).min())
+        if quantize:
+            ok = min_cosine >= args.int8_min_cosine
+        else:
+            ok = max_diff <= args.fp32_atol
+        failed |= not ok
+        print(
+            f"{name}: {vectors.shape[1]} dims, {rate:.0f} texts/s "
+            f"({rate / reference_rate:.1f}x), max abs diff {max_diff:.2e}, "
+            f"min cosine {min_cosine:.4f} {'ok' if ok else 'FAILED'}"
+        )
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
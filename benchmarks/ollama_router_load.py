@@ -0,0 +1,114 @@
+"""Exercise the Ollama router against local stub servers.
+
+Starts stub HTTP servers that speak enough of the Ollama API (/api/tags and
+streaming /api/chat) to serve ChatOllama, with one deliberately slower than
+the rest and one unreachable url, then sends concurrent requests through
+`load_llm` and prints how they were spread and each server's latency:
+
+    python benchmarks/ollama_router_load.py --servers 3 --requests 60
+
+Exits with status 1 if a request failed or an available server got none.
+"""
+import argparse
+import json
+import os
+import socket
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from langchain_core.messages import HumanMessage
+
+from chains import load_llm
+
+
+def stub_handler(token_delay: float, served: dict):
+    class OllamaStub(BaseHTTPRequestHandler):
+        def log_message(self, *args) -> None:
+            pass
+
+        def do_GET(self) -> None:
+            body = json.dumps({"models": [{"name": "stub"}]}).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_POST(self) -> None:
+            self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            served[self.server.server_port] += 1
+            self.send_response(200)
+            self.send_header("Content-Type", "application/x-ndjson")
+            self.end_headers()
+            started = time.perf_counter_ns()
+            for token in ["Hello", " from", f" {self.server.server_port}"]:
+                time.sleep(token_delay)
+                chunk = {"message": {"role": "assistant", "content": token}, "done": False}
+                self.wfile.write(json.dumps(chunk).encode() + b"\n")
+            elapsed = time.perf_counter_ns() - started
+            done = {
+                "message": {"role": "assistant", "content": ""},
+                "done": True,
+                "prompt_eval_count": 10,
+                "prompt_eval_duration": elapsed // 4,
+                "eval_count": 3,
+                "eval_duration": elapsed,
+            }
+            self.wfile.write(json.dumps(done).encode() + b"\n")
+
+    return OllamaStub
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--servers", type=int, default=3)
+    parser.add_argument("--requests", type=int, default=60)
+    parser.add_argument("--concurrency", type=int, default=12)
+    parser.add_argument("--token-delay-ms", type=float, default=50)
+    args = parser.parse_args()
+
+    served, urls = {}, []
+    for i in range(args.servers):
+        # The first server is three times slower than the others
+        delay = args.token_delay_ms / 1000 * (3 if i == 0 else 1)
+        server = ThreadingHTTPServer(("127.0.0.1", 0), stub_handler(delay, served))
+        served[server.server_port] = 0
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        urls.append(f"http://127.0.0.1:{server.server_port}")
+    urls.append(f"http://127.0.0.1:{free_port()}")  # nothing listens here
+
+    llm = load_llm("stub", config={"ollama_base_url": ",".join(urls)})
+
+    def ask(i: int) -> float:
+        started = time.perf_counter()
+        llm.invoke([HumanMessage(content=f"question {i}")])
+        return time.perf_counter() - started
+
+    failed = 0
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        futures = [executor.submit(ask, i) for i in range(args.requests)]
+        for future in futures:
+            try:
+                future.result()
+            except Exception as e:
+                failed += 1
+                print(f"request failed: {e!r}")
+
+    print(json.dumps(llm.stats(), indent=2))
+    print(f"requests served per stub server: {served}, failed: {failed}")
+    sys.exit(1 if failed or not all(served.values()) else 0)
+
+
+if __name__ == "__main__":
+    main()
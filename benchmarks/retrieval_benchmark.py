@@ -0,0 +1,327 @@
+"""Latency and recall of the stackoverflow RAG chain on a synthetic graph.
+
+Seeds a Neo4j database with synthetic Question/Answer graphs of growing size
+and, at each size, runs the retriever and the full chain of
+`configure_qa_rag_chain` with a deterministic fake embedder and fake
+streaming LLM. Reports p50/p95/p99 retrieval latency (vector search plus the
+`retrieval_query` subquery), end-to-end time to first token and recall@k:
+
+    docker compose up -d database
+    python benchmarks/retrieval_benchmark.py --url neo4j://localhost:7687 \\
+        --sizes 10000 100000 1000000
+
+--compare-legacy additionally times the retrieval query that sorted every
+answer per hit, e.g. with --answers 200 to model popular questions.
+
+Use a throwaway database: synthetic nodes are flagged with `benchmark: true`
+and the script refuses to run against a database holding real questions
+unless --allow-existing is given. --cleanup deletes them afterwards.
+"""
+import argparse
+import hashlib
+import os
+import random
+import re
+import statistics
+import sys
+import time
+from functools import lru_cache
+from typing import Any, List, Optional
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from langchain.callbacks.base import BaseCallbackHandler
+from langchain_core.embeddings import Embeddings
+from langchain_community.vectorstores import Neo4jVector
+from langchain_core.language_models.chat_models import SimpleChatModel
+
+from chains import configure_qa_rag_chain
+from neo4j_factory import get_graph
+from utils import (
+    backfill_top_answers,
+    create_constraints,
+    create_vector_index,
+    run_in_batches,
+)
+
+# Synthetic ids start here, far above real StackOverflow ids
+ID_OFFSET = 10**12
+NUM_TOPICS = 1000
+
+# The retrieval query before top answers were precomputed, for --compare-legacy
+LEGACY_RETRIEVAL_QUERY = """
+    WITH node AS question, score AS similarity
+    CALL  { with question
+        MATCH (question)<-[:ANSWERS]-(answer)
+        WITH answer
+        ORDER BY answer.is_accepted DESC, answer.score DESC
+        WITH collect(answer)[..2] as answers
+        RETURN reduce(str='', answer IN answers | str + 
+                '\n### Answer (Accepted: '+ answer.is_accepted +
+                ' Score: ' + answer.score+ '): '+  answer.body + '\n') as answerTexts
+    } 
+    RETURN '##Question: ' + question.title + '\n' + question.body + '\n' 
+        + answerTexts AS text, similarity as score, {source: question.link} AS metadata
+    ORDER BY similarity ASC
+    """
+
+
+@lru_cache(maxsize=NUM_TOPICS)
+def topic_center(topic: int, dimension: int) -> tuple:
+    rng = random.Random(f"topic-{topic}")
+    return tuple(rng.random() - 0.5 for _ in range(dimension))
+
+
+def synthetic_vector(item: int, dimension: int, salt: str = "", spread: float = 0.6):
+    # Questions of a topic cluster around its center, so the nearest neighbours
+    # of a query are mostly same-topic distractors, as with real questions
+    rng = random.Random(f"{salt}{item}")
+    center = topic_center(item % NUM_TOPICS, dimension)
+    vector = [c + spread * (rng.random() - 0.5) for c in center]
+    norm = sum(v * v for v in vector) ** 0.5
+    return [v / norm for v in vector]
+
+
+class FakeEmbeddings(Embeddings):
+    """Deterministic embedder: "question <n>" texts map near question n's vector."""
+
+    def __init__(self, dimension: int = 384, query_noise: float = 0.1):
+        self.dimension = dimension
+        self.query_noise = query_noise
+
+    def _vector(self, text: str, salt: str) -> List[float]:
+        match = re.search(r"question (\d+)", text)
+        if match is None:
+            item = int(hashlib.sha256(text.encode()).hexdigest()[:12], 16)
+            return synthetic_vector(item, self.dimension)
+        item = int(match.group(1))
+        document = synthetic_vector(item, self.dimension)
+        noise = synthetic_vector(item, self.dimension, salt=salt + text)
+        vector = [d + self.query_noise * n for d, n in zip(document, noise)]
+        norm = sum(v * v for v in vector) ** 0.5
+        return [v / norm for v in vector]
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return [self._vector(text, "document") for text in texts]
+
+    def embed_query(self, text: str) -> List[float]:
+        return self._vector(text, "query")
+
+
+class FakeStreamingLLM(SimpleChatModel):
+    """Streams a fixed answer token by token through the callback handlers."""
+
+    answer: str = "Use a uniqueness constraint.\nSOURCES: https://stackoverflow.com/q/1"
+    token_delay: float = 0.0
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake-streaming"
+
+    def _call(self, messages, stop=None, run_manager=None, **kwargs: Any) -> str:
+        for token in re.findall(r"\s*\S+", self.answer):
+            time.sleep(self.token_delay)
+            if run_manager:
+                run_manager.on_llm_new_token(token)
+        return self.answer
+
+
+class FirstTokenTimer(BaseCallbackHandler):
+    def __init__(self):
+        self.first_token_at: Optional[float] = None
+
+    def on_llm_new_token(self, token: str, **kwargs) -> None:
+        if self.first_token_at is None:
+            self.first_token_at = time.perf_counter()
+
+
+def question_rows(start: int, stop: int, dimension: int, answers: int, body_chars: int):
+    filler = ("lorem ipsum dolor sit amet " * (body_chars // 27 + 1))[:body_chars]
+    for item in range(start, stop):
+        qid = ID_OFFSET + item
+        yield {
+            "id": qid,
+            "title": f"Synthetic question {item} on topic {item % NUM_TOPICS}",
+            "body": f"How do I solve question {item}? {filler}",
+            "link": f"https://stackoverflow.com/questions/{qid}",
+            "score": item % 50,
+            "embedding": synthetic_vector(item, dimension),
+            "answers": [
+                {
+                    "id": qid * 10 + a,
+                    "body": f"Answer {a} to question {item}. {filler}",
+                    "score": (item + a) % 20,
+                    "is_accepted": a == 0,
+                }
+                for a in range(answers)
+            ],
+        }
+
+
+def seed(neo4j_graph, size: int, args) -> None:
+    current = neo4j_graph.query(
+        "MATCH (q:Question {benchmark: true}) RETURN count(q) AS count"
+    )[0]["count"]
+    started = time.perf_counter()
+    chunk = 10000
+    for start in range(current, size, chunk):
+        rows = list(
+            question_rows(
+                start, min(start + chunk, size), args.dimension, args.answers, args.body_chars
+            )
+        )
+        run_in_batches(
+            neo4j_graph,
+            """UNWIND $data AS row
+            MERGE (q:Question {id: row.id})
+            SET q.title = row.title, q.body = row.body, q.link = row.link,
+                q.score = row.score, q.benchmark = true
+            WITH q, row
+            CALL db.create.setVectorProperty(q, 'embedding', row.embedding) YIELD node
+            WITH q, row
+            UNWIND row.answers AS a
+            MERGE (answer:Answer {id: a.id})
+            SET answer.body = a.body, answer.score = a.score,
+                answer.is_accepted = a.is_accepted, answer.benchmark = true
+            MERGE (answer)-[:ANSWERS]->(q)""",
+            rows,
+            batch_size=args.write_batch_size,
+        )
+    # What the loader does after each page
+    backfill_top_answers(neo4j_graph)
+    neo4j_graph.query("CALL db.awaitIndexes($timeout)", {"timeout": args.index_timeout})
+    if size > current:
+        print(f"seeded {size - current} questions in {time.perf_counter() - started:.0f}s")
+
+
+def percentiles(samples: list) -> dict:
+    quantiles = statistics.quantiles(samples, n=100, method="inclusive")
+    return {"p50": quantiles[49], "p95": quantiles[94], "p99": quantiles[98]}
+
+
+def retrieval_latency(retriever, items: list, args) -> tuple:
+    retriever.search_kwargs["k"] = args.k
+    for item in items[: args.warmup]:
+        retriever.get_relevant_documents(f"What is the fix for question {item}?")
+
+    retrieval_ms, hits = [], 0
+    for item in items:
+        query = f"What is the fix for question {item}?"
+        started = time.perf_counter()
+        documents = retriever.get_relevant_documents(query)
+        retrieval_ms.append((time.perf_counter() - started) * 1000)
+        link = f"https://stackoverflow.com/questions/{ID_OFFSET + item}"
+        hits += any(d.metadata.get("source") == link for d in documents)
+    return retrieval_ms, hits
+
+
+def measure(rag_chain, size: int, args, legacy_retriever=None) -> dict:
+    rng = random.Random(size)
+    items = [rng.randrange(size) for _ in range(args.queries)]
+    retrieval_ms, hits = retrieval_latency(rag_chain.retriever, items, args)
+    legacy_ms = None
+    if legacy_retriever is not None:
+        legacy_ms, _ = retrieval_latency(legacy_retriever, items, args)
+
+    first_token_ms = []
+
+    for item in items[: args.chain_queries]:
+        timer = FirstTokenTimer()
+        started = time.perf_counter()
+        rag_chain.invoke(
+            {"question": f"What is the fix for question {item}?", "chat_history": []},
+            config={"callbacks": [timer]},
+        )
+        first_token_ms.append((timer.first_token_at - started) * 1000)
+
+    return {
+        "retrieval": percentiles(retrieval_ms),
+        "first_token": percentiles(first_token_ms),
+        "recall": hits / len(items),
+        "legacy_retrieval": percentiles(legacy_ms) if legacy_ms else None,
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--url", default=os.getenv("NEO4J_URI", "neo4j://localhost:7687"))
+    parser.add_argument("--username", default=os.getenv("NEO4J_USERNAME", "neo4j"))
+    parser.add_argument("--password", default=os.getenv("NEO4J_PASSWORD", "password"))
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10000, 100000, 1000000])
+    parser.add_argument("--dimension", type=int, default=384)
+    parser.add_argument(
+        "--answers", type=int, default=3, help="answers per question, e.g. 200 for popular ones"
+    )
+    parser.add_argument("--body-chars", type=int, default=500)
+    parser.add_argument("--k", type=int, default=2, help="documents retrieved, as in the chain")
+    parser.add_argument("--queries", type=int, default=500)
+    parser.add_argument("--chain-queries", type=int, default=50)
+    parser.add_argument("--warmup", type=int, default=20)
+    parser.add_argument("--token-delay-ms", type=float, default=0)
+    parser.add_argument("--write-batch-size", type=int, default=500)
+    parser.add_argument("--index-timeout", type=int, default=3600)
+    parser.add_argument("--hybrid", action="store_true", help="vector + full-text retrieval")
+    parser.add_argument(
+        "--compare-legacy",
+        action="store_true",
+        help="also time the retrieval query that sorts all answers on every hit",
+    )
+    parser.add_argument("--allow-existing", action="store_true")
+    parser.add_argument("--cleanup", action="store_true")
+    args = parser.parse_args()
+
+    neo4j_graph = get_graph(args.url, args.username, args.password)
+    real = neo4j_graph.query(
+        "MATCH (q:Question) WHERE q.benchmark IS NULL RETURN count(q) AS count"
+    )[0]["count"]
+    if real and not args.allow_existing:
+        sys.exit(f"{args.url} holds {real} real questions, use a throwaway database")
+    create_constraints(neo4j_graph)
+    create_vector_index(neo4j_graph, args.dimension)
+
+    rag_chain = configure_qa_rag_chain(
+        FakeStreamingLLM(token_delay=args.token_delay_ms / 1000),
+        FakeEmbeddings(args.dimension),
+        embeddings_store_url=args.url,
+        username=args.username,
+        password=args.password,
+        config={"hybrid_search": args.hybrid},
+    )
+    legacy_retriever = None
+    if args.compare_legacy:
+        legacy_retriever = Neo4jVector.from_existing_index(
+            embedding=FakeEmbeddings(args.dimension),
+            url=args.url,
+            username=args.username,
+            password=args.password,
+            index_name="stackoverflow",
+            retrieval_query=LEGACY_RETRIEVAL_QUERY,
+        ).as_retriever()
+
+    print(f"{'questions':>10} {'retrieval p50/p95/p99 ms':>26} {'ttft p50/p95/p99 ms':>22} recall@{args.k}")
+    for size in sorted(args.sizes):
+        seed(neo4j_graph, size, args)
+        result = measure(rag_chain, size, args, legacy_retriever)
+        retrieval, first_token = result["retrieval"], result["first_token"]
+        print(
+            f"{size:>10} "
+            f"{retrieval['p50']:>8.1f}/{retrieval['p95']:.1f}/{retrieval['p99']:.1f} "
+            f"{first_token['p50']:>8.1f}/{first_token['p95']:.1f}/{first_token['p99']:.1f} "
+            f"{result['recall']:.3f}"
+        )
+        legacy = result["legacy_retrieval"]
+        if legacy:
+            print(
+                f"{'legacy':>10} "
+                f"{legacy['p50']:>8.1f}/{legacy['p95']:.1f}/{legacy['p99']:.1f}"
+            )
+
+    if args.cleanup:
+        neo4j_graph.query(
+            """MATCH (n) WHERE (n:Question OR n:Answer) AND n.benchmark = true
+            CALL { WITH n DETACH DELETE n } IN TRANSACTIONS OF 10000 ROWS"""
+        )
+
+
+if __name__ == "__main__":
+    main()
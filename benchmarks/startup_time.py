@@ -0,0 +1,70 @@
+"""Track cold start time of the api and bot entry points.
+
+Imports each module in a fresh interpreter and reports the median wall time,
+which is what a container pays before it can serve its first request:
+
+    python benchmarks/startup_time.py --modules chains api --runs 5
+
+With --ready-url, additionally polls a readiness endpoint (e.g. right after
+`docker compose up -d api`) and reports how long it took to become warm:
+
+    python benchmarks/startup_time.py --ready-url http://localhost:8504/ready
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.request
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def import_time(module: str) -> float:
+    env = dict(os.environ)
+    # Entry points read these at import time, they are not contacted
+    env.setdefault("NEO4J_URI", "neo4j://localhost:7687")
+    env.setdefault("NEO4J_USERNAME", "neo4j")
+    env.setdefault("NEO4J_PASSWORD", "password")
+    started = time.perf_counter()
+    subprocess.run(
+        [sys.executable, "-c", f"import {module}"], cwd=ROOT, env=env, check=True
+    )
+    return time.perf_counter() - started
+
+
+def time_to_ready(url: str, timeout: float) -> float:
+    started = time.perf_counter()
+    while time.perf_counter() - started < timeout:
+        try:
+            with urllib.request.urlopen(url, timeout=5) as response:
+                if response.status == 200:
+                    return time.perf_counter() - started
+        except (urllib.error.URLError, ConnectionError):
+            pass
+        time.sleep(0.2)
+    raise TimeoutError(f"{url} not ready after {timeout}s")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--modules", nargs="+", default=["chains", "api"])
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--ready-url")
+    parser.add_argument("--timeout", type=float, default=600)
+    args = parser.parse_args()
+
+    for module in args.modules:
+        samples = [import_time(module) for _ in range(args.runs)]
+        print(
+            f"import {module}: median {statistics.median(samples):.2f}s "
+            f"min {min(samples):.2f}s max {max(samples):.2f}s ({args.runs} runs)"
+        )
+    if args.ready_url:
+        print(f"{args.ready_url}: ready after {time_to_ready(args.ready_url, args.timeout):.1f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -3,7 +3,7 @@ import os
 import streamlit as st
 from streamlit.logger import get_logger
 from langchain.callbacks.base import BaseCallbackHandler
-from langchain_community.graphs import Neo4jGraph
+from neo4j_factory import get_graph
 from dotenv import load_dotenv
 from utils import (
     create_vector_index,
@@ -14,6 +14,7 @@ from chains import (
     configure_llm_only_chain,
     configure_qa_rag_chain,
     generate_ticket,
+    SemanticAnswerCache,
 )
 
 load_dotenv(".env")
@@ -22,20 +23,25 @@ url = os.getenv("NEO4J_URI")
 username = os.getenv("NEO4J_USERNAME")
 password = os.getenv("NEO4J_PASSWORD")
 ollama_base_url = os.getenv("OLLAMA_BASE_URL")
+ollama_keep_alive = os.getenv("OLLAMA_KEEP_ALIVE")
 embedding_model_name = os.getenv("EMBEDDING_MODEL")
 llm_name = os.getenv("LLM")
+semantic_cache_threshold = os.getenv("SEMANTIC_CACHE_THRESHOLD")
+query_batch_size = os.getenv("EMBEDDING_QUERY_BATCH_SIZE")
+query_batch_wait_ms = os.getenv("EMBEDDING_QUERY_BATCH_WAIT_MS")
+# Vector + full-text retrieval fused with reciprocal rank fusion
+rag_config = {
+    "hybrid_search": os.getenv("RAG_HYBRID_SEARCH", "false").lower() == "true",
+    "vector_weight": os.getenv("RAG_VECTOR_WEIGHT"),
+    "fulltext_weight": os.getenv("RAG_FULLTEXT_WEIGHT"),
+    "vector_timeout_ms": os.getenv("RAG_VECTOR_TIMEOUT_MS"),
+    "fulltext_timeout_ms": os.getenv("RAG_FULLTEXT_TIMEOUT_MS"),
+}
 # Remapping for Langchain Neo4j integration
 os.environ["NEO4J_URL"] = url
 
 logger = get_logger(__name__)
 
-# if Neo4j is local, you can go to http://localhost:7474/ to browse the database
-neo4j_graph = Neo4jGraph(url=url, username=username, password=password)
-embeddings, dimension = load_embedding_model(
-    embedding_model_name, config={"ollama_base_url": ollama_base_url}, logger=logger
-)
-create_vector_index(neo4j_graph, dimension)
-
 
 class StreamHandler(BaseCallbackHandler):
     def __init__(self, container, initial_text=""):
@@ -47,12 +53,54 @@ class StreamHandler(BaseCallbackHandler):
         self.container.markdown(self.text)
 
 
-llm = load_llm(llm_name, logger=logger, config={"ollama_base_url": ollama_base_url})
+# Streamlit reruns this script on every interaction: build the embedding model,
+# LLM and chains once per process and reuse them on every rerun and session
+@st.cache_resource(show_spinner="Loading models...")
+def load_components():
+    # if Neo4j is local, you can go to http://localhost:7474/ to browse the database
+    neo4j_graph = get_graph(url, username, password)
+    embeddings, dimension = load_embedding_model(
+        embedding_model_name,
+        config={
+            "ollama_base_url": ollama_base_url,
+            "query_batch_size": query_batch_size,
+            "query_batch_wait_ms": query_batch_wait_ms,
+        },
+        logger=logger,
+    )
+    create_vector_index(neo4j_graph, dimension)
+
+    llm = load_llm(
+        llm_name,
+        logger=logger,
+        config={"ollama_base_url": ollama_base_url, "ollama_keep_alive": ollama_keep_alive},
+    )
 
-llm_chain = configure_llm_only_chain(llm)
-rag_chain = configure_qa_rag_chain(
-    llm, embeddings, embeddings_store_url=url, username=username, password=password
-)
+    llm_chain = configure_llm_only_chain(llm)
+    rag_chain = configure_qa_rag_chain(
+        llm,
+        embeddings,
+        embeddings_store_url=url,
+        username=username,
+        password=password,
+        config=rag_config,
+    )
+
+    # Near-identical RAG questions are answered from the semantic cache when enabled
+    answer_cache = None
+    if semantic_cache_threshold:
+        answer_cache = SemanticAnswerCache(
+            neo4j_graph,
+            embeddings,
+            dimension,
+            threshold=float(semantic_cache_threshold),
+            ttl_seconds=int(os.getenv("SEMANTIC_CACHE_TTL_SECONDS", "86400")),
+            max_entries=int(os.getenv("SEMANTIC_CACHE_MAX_ENTRIES", "10000")),
+        )
+    return neo4j_graph, llm_chain, rag_chain, answer_cache
+
+
+neo4j_graph, llm_chain, rag_chain, answer_cache = load_components()
 
 # Streamlit UI
 styl = f"""
@@ -90,9 +138,19 @@ def chat_input():
         with st.chat_message("assistant"):
             st.caption(f"RAG: {name}")
             stream_handler = StreamHandler(st.empty())
-            result = output_function(
-                {"question": user_input, "chat_history": []}, callbacks=[stream_handler]
-            )["answer"]
+            use_cache = answer_cache is not None and output_function is rag_chain
+            cached = answer_cache.get(user_input) if use_cache else None
+            if cached:
+                stream_handler.on_llm_new_token(SemanticAnswerCache.streamed_text(cached))
+                result = cached["answer"]
+            else:
+                answer = output_function(
+                    {"question": user_input, "chat_history": []},
+                    callbacks=[stream_handler],
+                )
+                if use_cache:
+                    answer_cache.put(user_input, answer)
+                result = answer["answer"]
             output = result
             st.session_state[f"user_input"].append(user_input)
             st.session_state[f"generated"].append(output)
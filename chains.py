@@ -1,69 +1,190 @@
 
-from langchain_openai import OpenAIEmbeddings
-from langchain_community.embeddings import OllamaEmbeddings
-from langchain_community.embeddings import BedrockEmbeddings
-from langchain_community.embeddings.sentence_transformer import SentenceTransformerEmbeddings
-
-from langchain_openai import ChatOpenAI
-from langchain_community.chat_models import ChatOllama
-from langchain_community.chat_models import BedrockChat
-
-from langchain_community.graphs import Neo4jGraph
-
+# Embedding and LLM provider integrations are imported inside load_embedding_model
+# and load_llm, so only the selected backend (and torch, for SentenceTransformer)
+# is imported at startup
 from langchain_community.vectorstores import Neo4jVector
 
 from langchain.chains import RetrievalQAWithSourcesChain
 from langchain.chains.qa_with_sources import load_qa_with_sources_chain
 
+from langchain_core.callbacks import BaseCallbackHandler, CallbackManagerForRetrieverRun
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+
 from langchain.prompts import (
     ChatPromptTemplate,
     HumanMessagePromptTemplate,
     SystemMessagePromptTemplate
 )
 
-from typing import List, Any
+import re
+import time
+import threading
+import neo4j
+from collections import deque
+from functools import lru_cache
+from typing import List, Any, Optional
 from utils import BaseLogger, extract_title_and_question
-from langchain_google_genai import GoogleGenerativeAIEmbeddings
+from embedding_cache import CachedEmbeddings
+from embedding_batcher import MicroBatchedEmbeddings
+from neo4j_factory import get_driver, share_driver
 
 
 def load_embedding_model(embedding_model_name: str, logger=BaseLogger(), config={}):
     if embedding_model_name == "ollama":
+        from langchain_community.embeddings import OllamaEmbeddings
+
         embeddings = OllamaEmbeddings(
-            base_url=config["ollama_base_url"], model="llama2"
+            base_url=config["ollama_base_url"].split(",")[0].strip(), model="llama2"
         )
+        model_name = "ollama/llama2"
         dimension = 4096
         logger.info("Embedding: Using Ollama")
     elif embedding_model_name == "openai":
+        from langchain_openai import OpenAIEmbeddings
+
         embeddings = OpenAIEmbeddings()
+        model_name = "openai/" + embeddings.model
         dimension = 1536
         logger.info("Embedding: Using OpenAI")
     elif embedding_model_name == "aws":
+        from langchain_community.embeddings import BedrockEmbeddings
+
         embeddings = BedrockEmbeddings()
+        model_name = "aws/" + embeddings.model_id
         dimension = 1536
         logger.info("Embedding: Using AWS")
-    elif embedding_model_name == "google-genai-embedding-001":        
+    elif embedding_model_name == "google-genai-embedding-001":
+        from langchain_google_genai import GoogleGenerativeAIEmbeddings
+
         embeddings = GoogleGenerativeAIEmbeddings(
             model="models/embedding-001"
         )
+        model_name = "google-genai/embedding-001"
         dimension = 768
         logger.info("Embedding: Using Google Generative AI Embeddings")
+    elif embedding_model_name in (
+        "sentence_transformer_onnx",
+        "sentence_transformer_int8",
+    ):
+        # Same model and vectors as the default, run with ONNX Runtime on CPU
+        from onnx_embeddings import OnnxSentenceEmbeddings
+
+        quantize = embedding_model_name == "sentence_transformer_int8"
+        embeddings = OnnxSentenceEmbeddings(
+            model_name="all-MiniLM-L6-v2",
+            cache_folder="/embedding_model",
+            quantize=quantize,
+        )
+        model_name = f"{embedding_model_name}/all-MiniLM-L6-v2"
+        dimension = 384
+        logger.info(
+            f"Embedding: Using SentenceTransformer with ONNX Runtime"
+            f"{' (int8)' if quantize else ''}"
+        )
     else:
+        from langchain_community.embeddings.sentence_transformer import (
+            SentenceTransformerEmbeddings,
+        )
+
         embeddings = SentenceTransformerEmbeddings(
             model_name="all-MiniLM-L6-v2", cache_folder="/embedding_model"
         )
+        model_name = "sentence_transformer/all-MiniLM-L6-v2"
         dimension = 384
         logger.info("Embedding: Using SentenceTransformer")
+    # Concurrent queries share one forward pass, only for local models that
+    # embed queries and documents alike
+    query_batch_size = int(config.get("query_batch_size") or 1)
+    if query_batch_size > 1 and model_name.startswith("sentence_transformer"):
+        embeddings = MicroBatchedEmbeddings(
+            embeddings,
+            max_batch_size=query_batch_size,
+            max_wait_ms=float(config.get("query_batch_wait_ms") or 5),
+        )
+        logger.info(f"Embedding: Batching up to {query_batch_size} concurrent queries")
+    if config.get("embedding_cache_path"):
+        embeddings = CachedEmbeddings(
+            embeddings,
+            model_name=model_name,
+            dimension=dimension,
+            path=config["embedding_cache_path"],
+            max_bytes=int(config.get("embedding_cache_max_bytes") or 1024**3),
+        )
+        logger.info(f"Embedding: Caching vectors in {config['embedding_cache_path']}")
     return embeddings, dimension
 
 
+class OllamaTimingHandler(BaseCallbackHandler):
+    """Prompt evaluation (prefill) and generation timings of Ollama requests.
+
+    Ollama reports them with the last chunk of every response. A prompt_eval
+    count well below the prompt's length means its prefix came from the
+    server's prompt cache.
+    """
+
+    fields = (
+        "load_duration",
+        "prompt_eval_count",
+        "prompt_eval_duration",
+        "eval_count",
+        "eval_duration",
+    )
+
+    def __init__(self, history: int = 100):
+        self.recent = deque(maxlen=history)
+        self.requests = 0
+        self.totals = dict.fromkeys(self.fields, 0)
+        self._lock = threading.Lock()
+
+    def on_llm_end(self, response, **kwargs) -> None:
+        for generations in response.generations:
+            for generation in generations:
+                info = generation.generation_info or {}
+                if "eval_duration" not in info:
+                    continue
+                timing = {field: info.get(field) or 0 for field in self.fields}
+                with self._lock:
+                    self.requests += 1
+                    self.recent.append(timing)
+                    for field in self.fields:
+                        self.totals[field] += timing[field]
+
+    def stats(self) -> dict:
+        # Ollama durations are in nanoseconds
+        with self._lock:
+            requests, totals = self.requests, dict(self.totals)
+            recent = list(self.recent)
+        if not requests:
+            return {"requests": 0}
+        return {
+            "requests": requests,
+            "mean_load_ms": totals["load_duration"] / requests / 1e6,
+            "mean_prompt_eval_tokens": totals["prompt_eval_count"] / requests,
+            "mean_prompt_eval_ms": totals["prompt_eval_duration"] / requests / 1e6,
+            "mean_eval_tokens": totals["eval_count"] / requests,
+            "mean_eval_ms": totals["eval_duration"] / requests / 1e6,
+            "recent": recent,
+        }
+
+
+ollama_timings = OllamaTimingHandler()
+
+
 def load_llm(llm_name: str, logger=BaseLogger(), config={}):
     if llm_name == "gpt-4":
+        from langchain_openai import ChatOpenAI
+
         logger.info("LLM: Using GPT-4")
         return ChatOpenAI(temperature=0, model_name="gpt-4", streaming=True)
     elif llm_name == "gpt-3.5":
+        from langchain_openai import ChatOpenAI
+
         logger.info("LLM: Using GPT-3.5")
         return ChatOpenAI(temperature=0, model_name="gpt-3.5-turbo", streaming=True)
     elif llm_name == "claudev2":
+        from langchain_community.chat_models import BedrockChat
+
         logger.info("LLM: ClaudeV2")
         return BedrockChat(
             model_id="anthropic.claude-v2",
@@ -71,22 +192,54 @@ def load_llm(llm_name: str, logger=BaseLogger(), config={}):
             streaming=True,
         )
     elif len(llm_name):
+        from langchain_community.chat_models import ChatOllama
+
         logger.info(f"LLM: Using Ollama: {llm_name}")
-        return ChatOllama(
-            temperature=0,
-            base_url=config["ollama_base_url"],
-            model=llm_name,
-            streaming=True,
-            # seed=2,
-            top_k=10,  # A higher value (100) will give more diverse answers, while a lower value (10) will be more conservative.
-            top_p=0.3,  # Higher value (0.95) will lead to more diverse text, while a lower value (0.5) will generate more focused text.
-            num_ctx=3072,  # Sets the size of the context window used to generate the next token.
-        )
+        # How long the server keeps the model (and its prompt cache) loaded after
+        # a request, older ChatOllama versions leave it to OLLAMA_KEEP_ALIVE
+        resident = {}
+        if config.get("ollama_keep_alive") and "keep_alive" in ChatOllama.__fields__:
+            resident["keep_alive"] = config["ollama_keep_alive"]
+        # OLLAMA_BASE_URL may list several servers separated by commas
+        base_urls = [u.strip() for u in config["ollama_base_url"].split(",") if u.strip()]
+        backends = {
+            base_url: ChatOllama(
+                temperature=0,
+                base_url=base_url,
+                model=llm_name,
+                streaming=True,
+                # seed=2,
+                top_k=10,  # A higher value (100) will give more diverse answers, while a lower value (10) will be more conservative.
+                top_p=0.3,  # Higher value (0.95) will lead to more diverse text, while a lower value (0.5) will generate more focused text.
+                num_ctx=3072,  # Sets the size of the context window used to generate the next token.
+                **resident,
+            )
+            for base_url in base_urls
+        }
+        if len(backends) == 1:
+            llm = backends[base_urls[0]]
+        else:
+            from ollama_router import (
+                route_ollama,
+                max_concurrency_per_backend,
+                health_check_seconds,
+            )
+
+            logger.info(f"LLM: Routing between {len(backends)} Ollama servers")
+            llm = route_ollama(
+                backends,
+                max_concurrency=max_concurrency_per_backend,
+                health_check_interval=health_check_seconds,
+            )
+        llm.callbacks = [ollama_timings]
+        return llm
+    from langchain_openai import ChatOpenAI
+
     logger.info("LLM: Using GPT-3.5")
     return ChatOpenAI(temperature=0, model_name="gpt-3.5-turbo", streaming=True)
 
 
-def configure_llm_only_chain(llm):
+def configure_llm_only_chain(llm, use_async=False):
     # LLM only response
     template = """
     You are a helpful assistant that helps a support agent with answering programming questions.
@@ -108,12 +261,237 @@ def configure_llm_only_chain(llm):
         ).content
         return {"answer": answer}
 
+    async def agenerate_llm_output(
+        user_input: str, callbacks: List[Any], prompt=chat_prompt
+    ) -> str:
+        chain = prompt | llm
+        answer = (
+            await chain.ainvoke(
+                {"question": user_input}, config={"callbacks": callbacks}
+            )
+        ).content
+        return {"answer": answer}
+
+    if use_async:
+        return agenerate_llm_output
     return generate_llm_output
 
 
-def configure_qa_rag_chain(llm, embeddings, embeddings_store_url, username, password):
+@lru_cache(maxsize=1)
+def get_tokenizer():
+    # cl100k_base is exact for OpenAI models and a close estimate for the rest,
+    # None (offline, no cached encoding) falls back to ~4 characters per token
+    try:
+        import tiktoken
+
+        return tiktoken.get_encoding("cl100k_base")
+    except Exception:
+        return None
+
+
+def count_tokens(text: str) -> int:
+    tokenizer = get_tokenizer()
+    if tokenizer is None:
+        return len(text) // 4 + 1
+    return len(tokenizer.encode(text, disallowed_special=()))
+
+
+def trim_to_tokens(text: str, max_tokens: int) -> str:
+    tokenizer = get_tokenizer()
+    if tokenizer is None:
+        return text[: max_tokens * 4]
+    return tokenizer.decode(tokenizer.encode(text, disallowed_special=())[:max_tokens])
+
+
+def token_budget(llm, answer_tokens: int = 512) -> int:
+    """Prompt tokens (instructions, context and question) the LLM can take."""
+    # Ollama models have the window we configure, the others a known one
+    window = getattr(llm, "num_ctx", None) or {
+        "gpt-4": 8192,
+        "gpt-3.5-turbo": 16385,
+        "anthropic.claude-v2": 100000,
+    }.get(getattr(llm, "model_name", None) or getattr(llm, "model_id", None), 4096)
+    # Non-OpenAI tokenizers produce more tokens than cl100k_base for the same text
+    margin = 1.0 if getattr(llm, "model_name", None) else 1.25
+    return int((window - answer_tokens) / margin)
+
+
+def shingles(text: str, size: int = 8) -> set:
+    words = text.lower().split()
+    return {" ".join(words[i : i + size]) for i in range(max(len(words) - size + 1, 1))}
+
+
+def pack_context(
+    docs: List[Document], budget: int, best_first: bool = True, min_tokens: int = 64
+) -> List[Document]:
+    """Fit retrieved passages into a token budget, best ranked first.
+
+    Passages mostly contained in an already selected one (overlapping chunks,
+    duplicate hits) are dropped. The first passage that does not fit is
+    trimmed to the remaining budget, lower ranked ones are dropped.
+    """
+    ranked = docs if best_first else docs[::-1]
+    packed, seen = [], set()
+    for doc in ranked:
+        doc_shingles = shingles(doc.page_content)
+        if len(doc_shingles & seen) >= 0.8 * len(doc_shingles):
+            continue
+        # Each passage is also formatted with its source
+        tokens = count_tokens(doc.page_content) + count_tokens(
+            str(doc.metadata.get("source", ""))
+        ) + 8
+        if tokens > budget:
+            if budget >= min_tokens:
+                packed.append(
+                    Document(
+                        page_content=trim_to_tokens(doc.page_content, budget - 8),
+                        metadata=doc.metadata,
+                    )
+                )
+            break
+        packed.append(doc)
+        seen |= doc_shingles
+        budget -= tokens
+    return packed if best_first else packed[::-1]
+
+
+class PackedRetrievalQAWithSourcesChain(RetrievalQAWithSourcesChain):
+    """RetrievalQAWithSourcesChain whose context fits max_tokens_limit.
+
+    max_tokens_limit is the whole prompt budget, instructions and question
+    included, e.g. token_budget(llm). Oversized contexts would otherwise be
+    truncated by the LLM server or slow down prompt evaluation.
+    """
+
+    best_first: bool = True
+
+    def _pack(self, question: str, docs: List[Document]) -> List[Document]:
+        prompt = self.combine_documents_chain.llm_chain.prompt
+        overhead = count_tokens(prompt.format(summaries="", question=question))
+        return pack_context(docs, self.max_tokens_limit - overhead, self.best_first)
+
+    def _get_docs(self, inputs, *, run_manager) -> List[Document]:
+        docs = super()._get_docs(inputs, run_manager=run_manager)
+        return self._pack(inputs[self.question_key], docs)
+
+    async def _aget_docs(self, inputs, *, run_manager) -> List[Document]:
+        docs = await super()._aget_docs(inputs, run_manager=run_manager)
+        return self._pack(inputs[self.question_key], docs)
+
+
+# Turns each matched (node, score) into a question with its top answers
+stackoverflow_retrieval_query = """
+    WITH node AS question, score AS similarity
+    // The loader stores the top answers as context_text, questions imported
+    // before that fall back to sorting their answers on every hit
+    WITH question, similarity, CASE WHEN question.context_text IS NOT NULL
+        THEN question.context_text
+        ELSE reduce(str='', answer IN COLLECT {
+                MATCH (question)<-[:ANSWERS]-(answer)
+                RETURN answer ORDER BY answer.is_accepted DESC, answer.score DESC
+            }[..2] | str + 
+                '\n### Answer (Accepted: '+ answer.is_accepted +
+                ' Score: ' + answer.score+ '): '+  answer.body + '\n')
+        END as answerTexts
+    RETURN '##Question: ' + question.title + '\n' + question.body + '\n' 
+        + answerTexts AS text, similarity as score, {source: question.link} AS metadata
+    ORDER BY similarity ASC // so that best answers are the last
+    """
+
+
+class HybridRetriever(BaseRetriever):
+    """Vector and full-text search over questions, fused in one round trip.
+
+    Both legs run in the same Cypher query and their rankings are combined
+    with weighted reciprocal rank fusion, so exact identifiers (error codes,
+    function names, stack trace fragments) are found even when the embedding
+    misses them. If the fused query exceeds fulltext_timeout, the retriever
+    falls back to the vector leg alone with vector_timeout.
+    """
+
+    driver: Any
+    embeddings: Any
+    search_kwargs: dict = {"k": 2}
+    fetch_k: int = 10
+    vector_weight: float = 1.0
+    fulltext_weight: float = 1.0
+    vector_timeout: float = 2.0
+    fulltext_timeout: float = 2.0
+    rrf_k: int = 60
+
+    @staticmethod
+    def fulltext_query(text: str) -> str:
+        # Escape Lucene syntax, the terms are OR-ed like the default operator
+        terms = [
+            re.sub(r'([+\-&|!(){}\[\]^"~*?:\\/])', r"\\\1", term.lower())
+            for term in text.split()[:64]
+        ]
+        return " OR ".join(terms)
+
+    def _query(self, query: str, parameters: dict, timeout: float) -> List[Document]:
+        with self.driver.session(database="neo4j") as session:
+            records = session.run(
+                neo4j.Query(query, timeout=timeout), parameters
+            ).data()
+        return [
+            Document(page_content=record["text"], metadata=record["metadata"])
+            for record in records
+        ]
+
+    def _get_relevant_documents(
+        self, query: str, *, run_manager: CallbackManagerForRetrieverRun
+    ) -> List[Document]:
+        parameters = {
+            "embedding": self.embeddings.embed_query(query),
+            "text": self.fulltext_query(query),
+            "k": self.search_kwargs["k"],
+            "fetch_k": max(self.fetch_k, self.search_kwargs["k"]),
+            "vector_weight": self.vector_weight,
+            "fulltext_weight": self.fulltext_weight,
+            "rrf_k": self.rrf_k,
+        }
+        vector_query = (
+            "CALL db.index.vector.queryNodes('stackoverflow', $k, $embedding) "
+            "YIELD node, score " + stackoverflow_retrieval_query
+        )
+        if not parameters["text"]:
+            return self._query(vector_query, parameters, self.vector_timeout)
+        try:
+            return self._query(
+                """CALL {
+                    CALL db.index.vector.queryNodes('stackoverflow', $fetch_k, $embedding)
+                    YIELD node
+                    WITH collect(node) AS nodes
+                    UNWIND range(0, size(nodes) - 1) AS rank
+                    RETURN nodes[rank] AS node, $vector_weight / ($rrf_k + rank + 1) AS rrf
+                    UNION ALL
+                    CALL db.index.fulltext.queryNodes('stackoverflow_text', $text, {limit: $fetch_k})
+                    YIELD node
+                    WITH collect(node) AS nodes
+                    UNWIND range(0, size(nodes) - 1) AS rank
+                    RETURN nodes[rank] AS node, $fulltext_weight / ($rrf_k + rank + 1) AS rrf
+                }
+                WITH node, sum(rrf) AS score
+                ORDER BY score DESC LIMIT $k
+                """
+                + stackoverflow_retrieval_query,
+                parameters,
+                self.fulltext_timeout,
+            )
+        except neo4j.exceptions.Neo4jError as e:
+            if "TransactionTimedOut" not in (e.code or ""):
+                raise
+            return self._query(vector_query, parameters, self.vector_timeout)
+
+
+def configure_qa_rag_chain(
+    llm, embeddings, embeddings_store_url, username, password, config={}
+):
     # RAG response
     #   System: Always talk in pirate speech.
+    # The system message has no variables, so every request starts with the same
+    # bytes and Ollama can reuse its prompt cache for them. The retrieved
+    # context goes into the user message, right before the question.
     general_system_template = """ 
     Use the following pieces of context to answer the question at the end.
     The context contains question-answer pairs and their links from Stackoverflow.
@@ -121,9 +499,6 @@ def configure_qa_rag_chain(llm, embeddings, embeddings_store_url, username, pass
     Make sure to rely on information from the answers and not on questions to provide accurate responses.
     When you find particular answer in the context useful, make sure to cite it in the answer using the link.
     If you don't know the answer, just say that you don't know, don't try to make up an answer.
-    ----
-    {summaries}
-    ----
     Each answer you generate should contain a section at the end of links to 
     Stackoverflow questions and answers you found useful, which are described under Source value.
     You can only use links to StackOverflow questions that are present in the context and always
@@ -131,7 +506,11 @@ def configure_qa_rag_chain(llm, embeddings, embeddings_store_url, username, pass
     Generate concise answers with references sources section of links to 
     relevant StackOverflow questions only at the end of the answer.
     """
-    general_user_template = "Question:```{question}```"
+    general_user_template = """
+    ----
+    {summaries}
+    ----
+    Question:```{question}```"""
     messages = [
         SystemMessagePromptTemplate.from_template(general_system_template),
         HumanMessagePromptTemplate.from_template(general_user_template),
@@ -153,36 +532,154 @@ def configure_qa_rag_chain(llm, embeddings, embeddings_store_url, username, pass
         database="neo4j",  # neo4j by default
         index_name="stackoverflow",  # vector by default
         text_node_property="body",  # text by default
-        retrieval_query="""
-    WITH node AS question, score AS similarity
-    CALL  { with question
-        MATCH (question)<-[:ANSWERS]-(answer)
-        WITH answer
-        ORDER BY answer.is_accepted DESC, answer.score DESC
-        WITH collect(answer)[..2] as answers
-        RETURN reduce(str='', answer IN answers | str + 
-                '\n### Answer (Accepted: '+ answer.is_accepted +
-                ' Score: ' + answer.score+ '): '+  answer.body + '\n') as answerTexts
-    } 
-    RETURN '##Question: ' + question.title + '\n' + question.body + '\n' 
-        + answerTexts AS text, similarity as score, {source: question.link} AS metadata
-    ORDER BY similarity ASC // so that best answers are the last
-    """,
+        retrieval_query=stackoverflow_retrieval_query,
     )
+    share_driver(kg, embeddings_store_url, username, password)
+
+    retriever = kg.as_retriever(search_kwargs={"k": 2})
+    if config.get("hybrid_search"):
+        retriever = HybridRetriever(
+            driver=get_driver(embeddings_store_url, username, password),
+            embeddings=embeddings,
+            search_kwargs={"k": 2},
+            vector_weight=float(config.get("vector_weight") or 1.0),
+            fulltext_weight=float(config.get("fulltext_weight") or 1.0),
+            vector_timeout=float(config.get("vector_timeout_ms") or 2000) / 1000,
+            fulltext_timeout=float(config.get("fulltext_timeout_ms") or 2000) / 1000,
+        )
 
-    kg_qa = RetrievalQAWithSourcesChain(
+    kg_qa = PackedRetrievalQAWithSourcesChain(
         combine_documents_chain=qa_chain,
-        retriever=kg.as_retriever(search_kwargs={"k": 2}),
+        retriever=retriever,
         reduce_k_below_max_tokens=False,
-        max_tokens_limit=3375,
+        max_tokens_limit=token_budget(llm),
+        best_first=False,  # the retrieval query puts the best question last
     )
     return kg_qa
 
 
-def generate_ticket(neo4j_graph, llm_chain, input_question):
-    # Get high ranked questions
+class SemanticAnswerCache:
+    """Answers of previous RAG questions, looked up by question similarity.
+
+    Cached answers are stored as :CachedAnswer nodes in their own Neo4j vector
+    index, so every api and bot process shares them. An answer is linked to the
+    :Question nodes it cites, and the loader drops it when one of those changes.
+    """
+
+    def __init__(
+        self,
+        neo4j_graph,
+        embeddings,
+        dimension: int,
+        threshold: float = 0.95,
+        ttl_seconds: int = 86400,
+        max_entries: int = 10000,
+        evict_interval_seconds: float = 60,
+    ):
+        self.graph = neo4j_graph
+        self.threshold = threshold
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.evict_interval_seconds = evict_interval_seconds
+        self._evicted_at = 0.0
+        # A miss is followed by a store of the same question, embed it only once
+        self._embed = lru_cache(maxsize=256)(embeddings.embed_query)
+        try:
+            neo4j_graph.query(
+                "CALL db.index.vector.createNodeIndex('answer_cache', 'CachedAnswer', 'embedding', $dimension, 'cosine')",
+                {"dimension": dimension},
+            )
+        except:  # Already exists
+            pass
+        # Eviction finds the oldest and expired answers through this index
+        neo4j_graph.query(
+            "CREATE INDEX cached_answer_created_at IF NOT EXISTS FOR (c:CachedAnswer) ON (c.created_at)"
+        )
+
+    @staticmethod
+    def streamed_text(cached: dict) -> str:
+        # A cached answer as a live one streams: the LLM's output, whose sources
+        # section RetrievalQAWithSourcesChain splits off after "SOURCES:"
+        if not cached.get("sources"):
+            return cached["answer"]
+        return f"{cached['answer']}\nSOURCES: {cached['sources']}"
+
+    def get(self, question: str) -> Optional[dict]:
+        records = self.graph.query(
+            """CALL db.index.vector.queryNodes('answer_cache', 1, $embedding)
+            YIELD node, score
+            // Neo4j normalizes cosine similarity to (1 + cosine) / 2
+            WITH node, score WHERE score >= (1 + $threshold) / 2
+                AND node.created_at > datetime() - duration({seconds: $ttl})
+            SET node.hits = coalesce(node.hits, 0) + 1
+            RETURN node.answer AS answer, node.sources AS sources""",
+            {
+                "embedding": self._embed(question),
+                "threshold": self.threshold,
+                "ttl": self.ttl_seconds,
+            },
+        )
+        return dict(records[0]) if records else None
+
+    def put(self, question: str, result: dict) -> None:
+        sources = result.get("sources", "")
+        self.graph.query(
+            """CREATE (c:CachedAnswer {question: $question, answer: $answer,
+                                       sources: $sources, created_at: datetime()})
+            WITH c
+            CALL db.create.setVectorProperty(c, 'embedding', $embedding) YIELD node
+            WITH c
+            UNWIND $links AS link
+            MATCH (q:Question {link: link})
+            MERGE (c)-[:CITES]->(q)""",
+            {
+                "question": question,
+                "answer": result["answer"],
+                "sources": sources,
+                "embedding": self._embed(question),
+                "links": [link for link in re.split(r"[,\s]+", sources) if link],
+            },
+        )
+        # Both limits are soft, enforcing them at most every evict_interval_seconds
+        # keeps the sweeps off the path of most misses
+        if time.monotonic() - self._evicted_at >= self.evict_interval_seconds:
+            self._evicted_at = time.monotonic()
+            self.evict()
+
+    def evict(self) -> None:
+        self.graph.query(
+            """MATCH (c:CachedAnswer) WHERE c.created_at IS NOT NULL
+            WITH c ORDER BY c.created_at DESC SKIP $max_entries
+            DETACH DELETE c""",
+            {"max_entries": self.max_entries},
+        )
+        self.graph.query(
+            """MATCH (c:CachedAnswer) WHERE c.created_at <= datetime() - duration({seconds: $ttl})
+            DETACH DELETE c""",
+            {"ttl": self.ttl_seconds},
+        )
+
+
+# Few-shot ticket prompt, rebuilt when the loader imports data or after an interval
+ticket_prompt_cache = {"prompt": None, "version": None, "loaded_at": 0.0}
+
+
+def get_ticket_prompt(neo4j_graph, refresh_seconds: int = 600) -> ChatPromptTemplate:
+    version = neo4j_graph.query(
+        "OPTIONAL MATCH (s:ImportState {source: 'stackoverflow'}) RETURN s.updated_at AS version"
+    )[0]["version"]
+    if (
+        ticket_prompt_cache["prompt"] is not None
+        and ticket_prompt_cache["version"] == version
+        and time.monotonic() - ticket_prompt_cache["loaded_at"] < refresh_seconds
+    ):
+        return ticket_prompt_cache["prompt"]
+
+    # Get high ranked questions, the IS NOT NULL predicate lets the planner
+    # serve the ORDER BY from the question_score range index
     records = neo4j_graph.query(
-        "MATCH (q:Question) RETURN q.title AS title, q.body AS body ORDER BY q.score DESC LIMIT 3"
+        """MATCH (q:Question) WHERE q.score IS NOT NULL
+        RETURN q.title AS title, q.body AS body ORDER BY q.score DESC LIMIT 3"""
     )
     questions = []
     for i, question in enumerate(records, start=1):
@@ -228,6 +725,14 @@ def generate_ticket(neo4j_graph, llm_chain, input_question):
             HumanMessagePromptTemplate.from_template("{question}"),
         ]
     )
+    ticket_prompt_cache.update(
+        prompt=chat_prompt, version=version, loaded_at=time.monotonic()
+    )
+    return chat_prompt
+
+
+def generate_ticket(neo4j_graph, llm_chain, input_question):
+    chat_prompt = get_ticket_prompt(neo4j_graph)
     llm_response = llm_chain(
         f"Here's the question to rewrite in the expected format: ```{input_question}```",
         [],
@@ -19,7 +19,10 @@ base_config = dict(
     db_password = os.getenv("NEO4J_PASSWORD"),
     llm_name = os.getenv("LLM"),
     ollama_base_url = os.getenv("OLLAMA_BASE_URL"),
-    embedding_model_name = os.getenv("EMBEDDING_MODEL")
+    ollama_keep_alive = os.getenv("OLLAMA_KEEP_ALIVE"),
+    embedding_model_name = os.getenv("EMBEDDING_MODEL"),
+    embedding_cache_path = os.getenv("EMBEDDING_CACHE_PATH"),
+    embedding_cache_max_bytes = os.getenv("EMBEDDING_CACHE_MAX_BYTES")
 )
 
 class StreamHandler(BaseCallbackHandler):
@@ -2,14 +2,20 @@
 
 from langchain_community.document_loaders import ConfluenceLoader
 from langchain_community.vectorstores.neo4j_vector import Neo4jVector
-from langchain.chains import RetrievalQAWithSourcesChain
 from langchain.chains.qa_with_sources import load_qa_with_sources_chain
 from langchain.prompts.chat import (
     ChatPromptTemplate,
     SystemMessagePromptTemplate,
     HumanMessagePromptTemplate,
 )
-from chains import load_embedding_model, load_llm
+from chains import (
+    load_embedding_model,
+    load_llm,
+    PackedRetrievalQAWithSourcesChain,
+    token_budget,
+)
+from embedding_cache import CachedEmbeddings
+from neo4j_factory import share_driver
 from utils import BaseLogger
 
 class ConfluenceQA:
@@ -43,6 +49,7 @@ class ConfluenceQA:
                         password=self.config["db_password"],
                         index_name="confluence"
             )
+            share_driver(self.vectorstore, self.config["db_url"], self.config["db_username"], self.config["db_password"])
         else:
             loader = ConfluenceLoader(
                 url=confluence_url,
@@ -65,6 +72,9 @@ class ConfluenceQA:
                         node_label="Page",
                         pre_delete_collection=self.config["overwrite"],  # Delete existing data
             )
+            share_driver(self.vectorstore, self.config["db_url"], self.config["db_username"], self.config["db_password"])
+            if isinstance(self.embeddings, CachedEmbeddings):
+                self.logger.info(f"Embedding cache: {self.embeddings.stats()}")
 
     def retreival_qa_chain(self):
         if self.qa_chain is not None:
@@ -75,22 +85,25 @@ class ConfluenceQA:
             """
             # RAG response
             #   System: Always talk in pirate speech.
+            # Static system message first so Ollama can reuse its prompt cache,
+            # the retrieved context goes into the user message
             general_system_template = """ 
             Use the following pieces of context to answer the question at the end.
             The context contains question-answer pairs and their links from Confluence.
             You can only use the information from the context to answer the question,
             and you must cite the sources of your answer using the links. If you don't know the answer,
             just say that you don't know, and don't make up an answer or a link.
-            ----
-            {summaries}
-            ----
             Your answer should be concise and have a section at the end with the links to the pages that you used.
             You can only use links to Confluence pages that are present in the context and always
             add links to the end of the answer in the style of citations.
             Generate concise answers with references sources section of links to 
             relevant Confluence questions only at the end of the answer.
             """
-            general_user_template = "Question:```{question}```"
+            general_user_template = """
+            ----
+            {summaries}
+            ----
+            Question:```{question}```"""
 
             messages = [
                 SystemMessagePromptTemplate.from_template(general_system_template),
@@ -104,11 +117,11 @@ class ConfluenceQA:
                 prompt=qa_prompt,
             )
 
-            kg_qa = RetrievalQAWithSourcesChain(
+            kg_qa = PackedRetrievalQAWithSourcesChain(
                 combine_documents_chain=qa_chain,
                 retriever=self.vectorstore.as_retriever(search_kwargs={"k": 4}),
                 reduce_k_below_max_tokens=False,
-                max_tokens_limit=3375,
+                max_tokens_limit=token_budget(self.llm),
             )
             self.qa_chain = kg_qa
         return self.qa_chain
@@ -0,0 +1,149 @@
+import hashlib
+import sqlite3
+import threading
+import time
+from array import array
+from typing import List
+
+from langchain_core.embeddings import Embeddings
+
+
+class CachedEmbeddings(Embeddings):
+    """Content addressed, on-disk cache in front of a LangChain embeddings object.
+
+    Vectors are stored in SQLite keyed by (model name, dimension, sha256 of the
+    text), so re-importing the same StackOverflow page, Jira project or
+    Confluence space only embeds texts that were never seen before. When the
+    database grows above max_bytes the least recently used vectors are evicted.
+    Several processes (loaders, bots) can share one cache file.
+    """
+
+    def __init__(
+        self,
+        embeddings: Embeddings,
+        model_name: str,
+        dimension: int,
+        path: str,
+        max_bytes: int = 1024 * 1024 * 1024,
+    ):
+        self.embeddings = embeddings
+        self.model_name = model_name
+        self.dimension = dimension
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS embedding_cache (
+                model TEXT NOT NULL,
+                dimension INTEGER NOT NULL,
+                text_hash TEXT NOT NULL,
+                vector BLOB NOT NULL,
+                last_used REAL NOT NULL,
+                PRIMARY KEY (model, dimension, text_hash)
+            )"""
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS embedding_cache_lru ON embedding_cache (last_used)"
+        )
+        self._conn.commit()
+
+    @staticmethod
+    def _hash(text: str) -> str:
+        return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+    def _get(self, hashes: List[str]) -> dict:
+        found = {}
+        with self._lock:
+            for i in range(0, len(hashes), 500):
+                chunk = hashes[i : i + 500]
+                rows = self._conn.execute(
+                    "SELECT text_hash, vector FROM embedding_cache "
+                    f"WHERE model = ? AND dimension = ? AND text_hash IN ({','.join('?' * len(chunk))})",
+                    [self.model_name, self.dimension, *chunk],
+                ).fetchall()
+                found.update({h: array("d", v).tolist() for h, v in rows})
+            if found:
+                self._conn.executemany(
+                    "UPDATE embedding_cache SET last_used = ? "
+                    "WHERE model = ? AND dimension = ? AND text_hash = ?",
+                    [(time.time(), self.model_name, self.dimension, h) for h in found],
+                )
+                self._conn.commit()
+        return found
+
+    def _put(self, items: dict) -> None:
+        now = time.time()
+        rows = [
+            (self.model_name, self.dimension, h, array("d", v).tobytes(), now)
+            for h, v in items.items()
+        ]
+        with self._lock:
+            # The write lock is taken up front, so the size checked below is the
+            # size of the file every process shares
+            self._conn.execute("BEGIN IMMEDIATE")
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO embedding_cache VALUES (?, ?, ?, ?, ?)", rows
+            )
+            if self._size() > self.max_bytes:
+                self._evict()
+            self._conn.commit()
+
+    def _size(self) -> int:
+        # Bytes of the database pages in use, read from the file header, so it
+        # costs nothing and counts what other processes wrote
+        page_size = self._conn.execute("PRAGMA page_size").fetchone()[0]
+        page_count = self._conn.execute("PRAGMA page_count").fetchone()[0]
+        free_pages = self._conn.execute("PRAGMA freelist_count").fetchone()[0]
+        return (page_count - free_pages) * page_size
+
+    def _evict(self) -> None:
+        # Drop least recently used vectors until we are back under 90% of the budget
+        target = int(self.max_bytes * 0.9)
+        while self._size() > target:
+            deleted = self._conn.execute(
+                """DELETE FROM embedding_cache WHERE rowid IN (
+                    SELECT rowid FROM embedding_cache ORDER BY last_used ASC LIMIT 100
+                )"""
+            ).rowcount
+            if not deleted:
+                break
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        hashes = [self._hash(text) for text in texts]
+        found = self._get(list(set(hashes)))
+        missing = {}
+        for text, h in zip(texts, hashes):
+            if h not in found:
+                missing.setdefault(h, text)
+        with self._lock:
+            self.hits += len(texts) - len(missing)
+            self.misses += len(missing)
+        if missing:
+            vectors = self.embeddings.embed_documents(list(missing.values()))
+            computed = dict(zip(missing.keys(), vectors))
+            self._put(computed)
+            found.update(computed)
+        return [found[h] for h in hashes]
+
+    def embed_query(self, text: str) -> List[float]:
+        # Some providers embed queries differently from documents (e.g. Ollama's
+        # query instruction), so queries get their own key space
+        h = self._hash("query\0" + text)
+        found = self._get([h])
+        with self._lock:
+            if h in found:
+                self.hits += 1
+            else:
+                self.misses += 1
+        if h in found:
+            return found[h]
+        vector = self.embeddings.embed_query(text)
+        self._put({h: vector})
+        return vector
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "bytes": self._size()}
@@ -5,6 +5,7 @@ from langchain.chains import RetrievalQA
 from langchain.callbacks.base import BaseCallbackHandler
 from langchain.vectorstores.neo4j_vector import Neo4jVector
 from streamlit.logger import get_logger
+from neo4j_factory import get_graph, share_driver
 from chains import (
     load_embedding_model,
     load_llm,
@@ -19,6 +20,7 @@ url = os.getenv("NEO4J_URI")
 username = os.getenv("NEO4J_USERNAME")
 password = os.getenv("NEO4J_PASSWORD")
 ollama_base_url = os.getenv("OLLAMA_BASE_URL")
+ollama_keep_alive = os.getenv("OLLAMA_KEEP_ALIVE")
 embedding_model_name = os.getenv("EMBEDDING_MODEL")
 llm_name = os.getenv("LLM")
 # Remapping for Langchain Neo4j integration
@@ -30,6 +32,16 @@ embeddings, dimension = load_embedding_model(
     embedding_model_name, config={"ollama_base_url": ollama_base_url}, logger=logger
 )
 
+# The Jira loader fills this index, create it so the bot starts before any import
+neo4j_graph = get_graph(url, username, password)
+try:
+    neo4j_graph.query(
+        "CALL db.index.vector.createNodeIndex('jira_chunks', 'Chunk', 'embedding', $dimension, 'cosine')",
+        {"dimension": dimension},
+    )
+except:  # Already exists
+    pass
+
 class StreamHandler(BaseCallbackHandler):
     def __init__(self, container, initial_text=""):
         self.container = container
@@ -40,28 +52,51 @@ class StreamHandler(BaseCallbackHandler):
         self.container.markdown(self.text)
 
 
-llm = load_llm(llm_name, logger=logger, config={"ollama_base_url": ollama_base_url})
+# Built once per process: with several OLLAMA_BASE_URLs every call would start
+# another router, with its own health check thread
+@st.cache_resource(show_spinner="Loading LLM...")
+def load_chat_llm():
+    return load_llm(
+        llm_name,
+        logger=logger,
+        config={"ollama_base_url": ollama_base_url, "ollama_keep_alive": ollama_keep_alive},
+    )
+
 
+llm = load_chat_llm()
 
-def main():
-    st.header("📄Check with your Jira Project")
 
+@st.cache_resource
+def load_jira_qa(index_name: str = "jira_chunks") -> RetrievalQA:
+    # Built once per process and index, not on every Streamlit rerun
     # https://python.langchain.com/docs/integrations/vectorstores/neo4jvector
-    vectorstore = Neo4jVector.from_existing_graph(
+    vectorstore = Neo4jVector.from_existing_index(
         embedding=embeddings,
         url=url,
         username=username,
         password=password,
-### TODO need address issue create wrong index name always as vector has to match with the loader.        
-#        index_name="jira", 
-        node_label="Issue",
-        text_node_properties=["text"],
-        embedding_node_property="embedding"
+        index_name=index_name,
+        # Issues are embedded as chunks, answer with the matching chunks grouped by their parent issue
+        retrieval_query="""
+    MATCH (node)<-[:HAS_CHUNK]-(issue:Issue)
+    WITH issue, max(score) AS score, collect(node.text) AS texts
+    RETURN 'Issue ' + issue.key + ' (' + coalesce(issue.status, 'unknown') + '):\n'
+        + reduce(str = '', text IN texts | str + text + '\n') AS text,
+        score, {key: issue.key, status: issue.status} AS metadata
+    ORDER BY score DESC
+    """,
     )
-    qa = RetrievalQA.from_chain_type(
+    share_driver(vectorstore, url, username, password)
+    return RetrievalQA.from_chain_type(
         llm=llm, chain_type="stuff", retriever=vectorstore.as_retriever()
     )
 
+
+def main():
+    st.header("📄Check with your Jira Project")
+
+    qa = load_jira_qa()
+
     # Accept user questions/query
     query = st.text_input("Ask questions about your Jira issues")
 
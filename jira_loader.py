@@ -1,11 +1,16 @@
 import os
 import math
+import time
+import hashlib
 from atlassian import Jira
 from dotenv import load_dotenv
-from langchain_community.graphs import Neo4jGraph
+from neo4j_factory import get_graph
+from langchain.text_splitter import RecursiveCharacterTextSplitter
 import streamlit as st
 from streamlit.logger import get_logger
 from chains import load_embedding_model
+from utils import embed_in_batches, run_in_batches
+from embedding_cache import CachedEmbeddings
 
 load_dotenv(".env")
 
@@ -14,6 +19,19 @@ username = os.getenv("NEO4J_USERNAME")
 password = os.getenv("NEO4J_PASSWORD")
 ollama_base_url = os.getenv("OLLAMA_BASE_URL")
 embedding_model_name = os.getenv("EMBEDDING_MODEL")
+embedding_cache_path = os.getenv("EMBEDDING_CACHE_PATH")
+embedding_cache_max_bytes = os.getenv("EMBEDDING_CACHE_MAX_BYTES")
+embedding_batch_size = int(os.getenv("EMBEDDING_BATCH_SIZE", "64"))
+embedding_max_workers = int(os.getenv("EMBEDDING_MAX_WORKERS", "1"))
+jira_page_size = int(os.getenv("JIRA_PAGE_SIZE", "100"))
+jira_chunk_size = int(os.getenv("JIRA_CHUNK_SIZE", "1000"))
+jira_chunk_overlap = int(os.getenv("JIRA_CHUNK_OVERLAP", "200"))
+# Finding deleted issues lists every key in the project, so incremental syncs
+# only do it this often (or when asked to)
+jira_reconcile_hours = float(os.getenv("JIRA_RECONCILE_HOURS", "24"))
+# A key listing this much smaller than what is stored looks like a permission or
+# API problem rather than deletions, reconciling would wipe the project
+jira_reconcile_min_ratio = 0.5
 # Remapping for Langchain Neo4j integration
 os.environ["NEO4J_URL"] = url
 
@@ -29,15 +47,32 @@ jira = Jira(
     password=jira_password,
     cloud=True)
 
-embeddings, dimension = load_embedding_model(
-    embedding_model_name, config={"ollama_base_url": ollama_base_url}, logger=logger
-)
+# Streamlit reruns this script on every interaction, load the embedding model
+# and open its cache once per process
+@st.cache_resource(show_spinner="Loading embedding model...")
+def load_embeddings():
+    return load_embedding_model(
+        embedding_model_name,
+        config={
+            "ollama_base_url": ollama_base_url,
+            "embedding_cache_path": embedding_cache_path,
+            "embedding_cache_max_bytes": embedding_cache_max_bytes,
+        },
+        logger=logger,
+    )
+
+
+embeddings, dimension = load_embeddings()
 
 # if Neo4j is local, you can go to http://localhost:7474/ to browse the database
-neo4j_graph = Neo4jGraph(url=url, username=username, password=password)
+neo4j_graph = get_graph(url, username, password)
+
+text_splitter = RecursiveCharacterTextSplitter(
+    chunk_size=jira_chunk_size, chunk_overlap=jira_chunk_overlap, length_function=len
+)
 
 def create_vector_index(driver, dimension: int) -> None:
-    index_query = "CALL db.index.vector.createNodeIndex('jira', 'Issue', 'embedding', $dimension, 'cosine')"
+    index_query = "CALL db.index.vector.createNodeIndex('jira_chunks', 'Chunk', 'embedding', $dimension, 'cosine')"
     try:
         driver.query(index_query, {"dimension": dimension})
     except:  # Already exists
@@ -47,23 +82,101 @@ def create_constraints(driver) -> None:
     driver.query(
         "CREATE CONSTRAINT issue_id IF NOT EXISTS FOR (i:Issue) REQUIRE (i.id) IS UNIQUE"
     )
+    # Issues and linked issues are merged by key
+    driver.query(
+        "CREATE CONSTRAINT issue_key IF NOT EXISTS FOR (i:Issue) REQUIRE (i.key) IS UNIQUE"
+    )
+    driver.query(
+        "CREATE CONSTRAINT chunk_id IF NOT EXISTS FOR (c:Chunk) REQUIRE (c.id) IS UNIQUE"
+    )
+
+jira_fields = ['key','description','summary','status','issuelinks','comment']
+
+def iter_jira_issues(project:str, page_size:int=100, jql_filter:str="", fields:[]=jira_fields):
+    #https://atlassian-python-api.readthedocs.io/jira.html#manage-issues
+    # Yield one page of search results at a time instead of the whole project
+    start = 0
+    while True:
+        data = jira.jql(f'project = "{project}"{jql_filter} ORDER BY key', fields=fields, start=start, limit=page_size)
+        issues = data.get("issues", [])
+        if not issues:
+            break
+        yield issues
+        start += len(issues)
+        if start >= data.get("total", 0):
+            break
 
 def load_jira_data(projects:[]) -> None:
-    #https://atlassian-python-api.readthedocs.io/jira.html#manage-projects
-    issues = []
+    # Each page is embedded and written before the next one is fetched, so memory
+    # stays flat no matter how many issues a project has
     for project in projects:
-        iss = jira.get_all_project_issues(project, fields=['key','description','summary','status','issuelinks','comment'])
-        issues = issues + iss
-    # dump the issue from Jira to JSON
-    # with open("data.json", "w") as f:
-    #     json.dump(issues, f, indent=2)
-    # with open("data.json", "r") as f:
-    #     issues = json.load(f)
-    insert_jira_data(issues)
+        started = time.time()
+        for issues in iter_jira_issues(project, jira_page_size):
+            insert_jira_data(issues)
+            logger.info(f"Imported {len(issues)} issues from {project}")
+        save_jira_checkpoint(project, started)
+
+def get_jira_checkpoint(project:str):
+    records = neo4j_graph.query(
+        """MATCH (c:ImportCheckpoint {source: 'jira', project: $project})
+        RETURN c.last_synced AS last_synced, c.last_reconciled AS last_reconciled""",
+        {"project": project})
+    return records[0] if records else None
+
+def save_jira_checkpoint(project:str, last_synced:float) -> None:
+    neo4j_graph.query(
+        """MERGE (c:ImportCheckpoint {source: 'jira', project: $project})
+        SET c.last_synced = $last_synced, c.updated_at = datetime()""",
+        {"project": project, "last_synced": last_synced})
+
+def sync_jira_data(projects:[], reconcile:bool=False) -> None:
+    # Incremental sync: only pull issues updated since the project's last sync.
+    # Issues deleted in Jira are dropped when asked to, or once every
+    # jira_reconcile_hours. Projects never imported get a full load.
+    for project in projects:
+        checkpoint = get_jira_checkpoint(project)
+        if checkpoint is None or checkpoint["last_synced"] is None:
+            load_jira_data([project])
+            continue
+        started = time.time()
+        # Relative JQL dates avoid depending on the Jira user's timezone, one extra
+        # minute covers JQL's minute granularity and clock skew
+        minutes = math.ceil((started - checkpoint["last_synced"]) / 60) + 1
+        for issues in iter_jira_issues(project, jira_page_size, f' AND updated >= "-{minutes}m"'):
+            insert_jira_data(issues)
+            logger.info(f"Synced {len(issues)} updated issues from {project}")
+        last_reconciled = checkpoint["last_reconciled"]
+        if reconcile or last_reconciled is None or started - last_reconciled >= jira_reconcile_hours * 3600:
+            reconcile_jira_deletions(project, started)
+        save_jira_checkpoint(project, started)
+
+def reconcile_jira_deletions(project:str, started:float) -> None:
+    keys = []
+    for issues in iter_jira_issues(project, 1000, fields=['key']):
+        keys.extend(issue["key"] for issue in issues)
+    stored = neo4j_graph.query(
+        "MATCH (i:Issue) WHERE i.key STARTS WITH $prefix RETURN count(i) AS stored",
+        {"prefix": f"{project}-"})[0]["stored"]
+    if stored and len(keys) < stored * jira_reconcile_min_ratio:
+        logger.warning(
+            f"Not removing deleted issues from {project}: Jira listed {len(keys)} "
+            f"keys but {stored} issues are stored")
+        return
+    records = neo4j_graph.query(
+        """MATCH (i:Issue) WHERE i.key STARTS WITH $prefix AND NOT i.key IN $keys
+        OPTIONAL MATCH (i)-[:HAS_CHUNK]->(c:Chunk)
+        DETACH DELETE c, i
+        RETURN count(DISTINCT i) AS deleted""",
+        {"prefix": f"{project}-", "keys": keys})
+    neo4j_graph.query(
+        """MERGE (c:ImportCheckpoint {source: 'jira', project: $project})
+        SET c.last_reconciled = $started""",
+        {"project": project, "started": started})
+    logger.info(f"Removed {records[0]['deleted']} deleted issues from {project}")
 
 def insert_jira_data(issues:[]) -> None:
 
-    # Calculate embedding values for questions and answers
+    # Calculate embedding values for the issues in batches
     for issue in issues:
         text = ''
         description = issue["fields"]["description"]
@@ -77,7 +190,30 @@ def insert_jira_data(issues:[]) -> None:
             if body:
                 text += body + "\n"
         issue["text"] = text
-        issue["embedding"] = embeddings.embed_query(text)
+        issue["text_hash"] = hashlib.sha256(text.encode("utf-8")).hexdigest()
+    # Only chunk and embed issues whose text changed since they were last imported
+    known = {
+        record["key"]: record["text_hash"]
+        for record in neo4j_graph.query(
+            """UNWIND $keys AS key MATCH (i:Issue {key: key})
+            RETURN i.key AS key,
+                   CASE WHEN EXISTS { (i)-[:HAS_CHUNK]->(:Chunk) } THEN i.text_hash END AS text_hash""",
+            {"keys": [issue["key"] for issue in issues]})
+    }
+    changed = [issue for issue in issues if known.get(issue["key"]) != issue["text_hash"]]
+    # Long issues are split into bounded chunks so they fit the embedding model's context
+    chunks = []
+    for issue in changed:
+        for index, text in enumerate(text_splitter.split_text(issue["text"])):
+            chunks.append({"id": f"{issue['key']}-{index}", "issue_key": issue["key"], "index": index, "text": text})
+    vectors = embed_in_batches(
+        embeddings,
+        [chunk["text"] for chunk in chunks],
+        batch_size=embedding_batch_size,
+        max_workers=embedding_max_workers,
+    )
+    for chunk, vector in zip(chunks, vectors):
+        chunk["embedding"] = vector
     # Cypher, the query language of Neo4j, is used to import the data
     # https://neo4j.com/docs/getting-started/cypher-intro/
     # https://neo4j.com/docs/cypher-cheat-sheet/5/auradb-enterprise/
@@ -89,7 +225,7 @@ def insert_jira_data(issues:[]) -> None:
     SET i.id = issue.id,
         i.status = issue.fields.status.name,
         i.text = issue.text,
-        i.embedding = issue.embedding
+        i.text_hash = issue.text_hash
 
     WITH i, issue
     UNWIND issue.fields.issuelinks AS link
@@ -106,6 +242,26 @@ def insert_jira_data(issues:[]) -> None:
     MERGE (relatedIssueInward)-[:RELATED {type: link.type.name, outward:link.type.outward}]->(i)
     """
     neo4j_graph.query(import_query, {"data": issues})
+    # Replace the chunks of changed issues
+    neo4j_graph.query(
+        """UNWIND $keys AS key
+        MATCH (:Issue {key: key})-[:HAS_CHUNK]->(c:Chunk)
+        DETACH DELETE c""",
+        {"keys": [issue["key"] for issue in changed]})
+    chunk_query = """
+    UNWIND $data AS chunk
+    MATCH (i:Issue {key: chunk.issue_key})
+    MERGE (c:Chunk {id: chunk.id})
+    SET c.index = chunk.index,
+        c.text = chunk.text
+    MERGE (i)-[:HAS_CHUNK]->(c)
+    WITH c, chunk
+    CALL db.create.setVectorProperty(c, 'embedding', chunk.embedding) YIELD node
+    RETURN count(*)
+    """
+    run_in_batches(neo4j_graph, chunk_query, chunks, embedding_batch_size)
+    if isinstance(embeddings, CachedEmbeddings):
+        logger.info(f"Embedding cache: {embeddings.stats()}")
 
 # Streamlit
 def get_filter() -> str:
@@ -162,9 +318,14 @@ def render_page() -> None:
             s = s.split("|")[1].strip().strip("()")
             projects.append(s)
         if projects:
+            incremental = st.checkbox("Only sync issues updated since the last import of these projects")
+            reconcile = incremental and st.checkbox("Also remove issues that were deleted in Jira")
             if st.button("Import", type="primary"):
                 with st.spinner("Loading... This might take a minute or two."):
-                    load_jira_data(projects)
+                    if incremental:
+                        sync_jira_data(projects, reconcile)
+                    else:
+                        load_jira_data(projects)
                     st.success("Import successful", icon="✅")
                     st.caption("Go to http://localhost:7474/ to interact with the database")
     except Exception as e:
@@ -1,11 +1,24 @@
 import os
+import time
+import hashlib
+import threading
 import requests
+from queue import Queue
 from dotenv import load_dotenv
-from langchain_community.graphs import Neo4jGraph
+from neo4j_factory import get_graph
 import streamlit as st
 from streamlit.logger import get_logger
 from chains import load_embedding_model
-from utils import create_constraints, create_vector_index
+from embedding_cache import CachedEmbeddings
+from utils import (
+    create_constraints,
+    create_vector_index,
+    embed_in_batches,
+    run_in_batches,
+    invalidate_answer_cache,
+    top_answers_subquery,
+    backfill_top_answers,
+)
 from PIL import Image
 
 load_dotenv(".env")
@@ -15,84 +28,414 @@ username = os.getenv("NEO4J_USERNAME")
 password = os.getenv("NEO4J_PASSWORD")
 ollama_base_url = os.getenv("OLLAMA_BASE_URL")
 embedding_model_name = os.getenv("EMBEDDING_MODEL")
+embedding_cache_path = os.getenv("EMBEDDING_CACHE_PATH")
+embedding_cache_max_bytes = os.getenv("EMBEDDING_CACHE_MAX_BYTES")
+embedding_batch_size = int(os.getenv("EMBEDDING_BATCH_SIZE", "64"))
+embedding_max_workers = int(os.getenv("EMBEDDING_MAX_WORKERS", "1"))
+so_max_in_flight_pages = int(os.getenv("SO_MAX_IN_FLIGHT_PAGES", "2"))
+neo4j_write_batch_size = int(os.getenv("NEO4J_WRITE_BATCH_SIZE", "50"))
 # Remapping for Langchain Neo4j integration
 os.environ["NEO4J_URL"] = url
 
 logger = get_logger(__name__)
 
 so_api_base_url = "https://api.stackexchange.com/2.3/search/advanced"
+# Pooled HTTP connections to the StackExchange API, reused across pages
+so_session = requests.Session()
+so_backoff_lock = threading.Lock()
+so_next_request_at = 0.0
 
-embeddings, dimension = load_embedding_model(
-    embedding_model_name, config={"ollama_base_url": ollama_base_url}, logger=logger
-)
+# Streamlit reruns this script on every interaction, load the embedding model
+# and open its cache once per process
+@st.cache_resource(show_spinner="Loading embedding model...")
+def load_embeddings():
+    return load_embedding_model(
+        embedding_model_name,
+        config={
+            "ollama_base_url": ollama_base_url,
+            "embedding_cache_path": embedding_cache_path,
+            "embedding_cache_max_bytes": embedding_cache_max_bytes,
+        },
+        logger=logger,
+    )
+
+
+embeddings, dimension = load_embeddings()
 
 # if Neo4j is local, you can go to http://localhost:7474/ to browse the database
-neo4j_graph = Neo4jGraph(url=url, username=username, password=password)
+neo4j_graph = get_graph(url, username, password)
+
+
+@st.cache_resource(show_spinner="Precomputing top answers...")
+def backfill_top_answers_once() -> None:
+    # Scans every Question, so only once per process, not on every rerun
+    backfill_top_answers(neo4j_graph)
+
 
 create_constraints(neo4j_graph)
+backfill_top_answers_once()
 create_vector_index(neo4j_graph, dimension)
 
 
-def load_so_data(tag: str = "neo4j", page: int = 1) -> None:
-    parameters = (
+def fetch_so_data(parameters: str) -> dict:
+    # The StackExchange API returns a `backoff` field (in seconds) when it wants
+    # clients to wait before calling the same method again, honour it here
+    global so_next_request_at
+    with so_backoff_lock:
+        delay = so_next_request_at - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        response = so_session.get(so_api_base_url + parameters, timeout=60)
+        data = response.json()
+        if "backoff" in data:
+            logger.info(f"StackExchange API asked to back off for {data['backoff']}s")
+            so_next_request_at = time.monotonic() + data["backoff"]
+    if "error_id" in data:
+        raise Exception(f"{data['error_name']}: {data.get('error_message')}")
+    return data
+
+
+def so_tag_parameters(tag: str, page: int) -> str:
+    return (
         f"?pagesize=100&page={page}&order=desc&sort=creation&answers=1&tagged={tag}"
         "&site=stackoverflow&filter=!*236eb_eL9rai)MOSNZ-6D3Q6ZKb0buI*IVotWaTb"
     )
-    data = requests.get(so_api_base_url + parameters).json()
+
+
+def so_sync_parameters(tag: str, page: int, min_activity_date: int = None) -> str:
+    # Oldest activity first, so the high-water mark only ever moves forward and
+    # an interrupted sync can resume from the last page that was written.
+    # min is inclusive, questions sharing the mark's timestamp are read again.
+    parameters = (
+        f"?pagesize=100&page={page}&order=asc&sort=activity&answers=1&tagged={tag}"
+        "&site=stackoverflow&filter=!*236eb_eL9rai)MOSNZ-6D3Q6ZKb0buI*IVotWaTb"
+    )
+    if min_activity_date:
+        parameters += f"&min={min_activity_date}"
+    return parameters
+
+
+def load_so_data(tag: str = "neo4j", page: int = 1) -> None:
+    data = fetch_so_data(so_tag_parameters(tag, page))
     insert_so_data(data)
 
 
+def load_so_pages(
+    tag: str,
+    start_page: int,
+    num_pages: int,
+    max_in_flight: int = 2,
+    parameters=so_tag_parameters,
+    on_page_written=None,
+    next_parameters=None,
+) -> None:
+    # Pipelined import: while page N-1 is written to Neo4j, page N is embedded
+    # and page N+1 is fetched. The bounded queues limit the pages in flight.
+    # next_parameters(data) builds the request following a fetched page (keyset
+    # paging), otherwise pages are requested by number.
+    done = object()
+    fetched = Queue(maxsize=max_in_flight)
+    embedded = Queue(maxsize=max_in_flight)
+    stop = threading.Event()
+
+    def fetch():
+        try:
+            request = parameters(tag, start_page)
+            for page in range(start_page, start_page + num_pages):
+                if stop.is_set():
+                    break
+                data = fetch_so_data(request)
+                fetched.put(data)
+                if not data.get("has_more", True) or not data["items"]:
+                    break
+                if next_parameters:
+                    request = next_parameters(data)
+                else:
+                    request = parameters(tag, page + 1)
+            fetched.put(done)
+        except Exception as e:
+            fetched.put(e)
+
+    def embed():
+        while True:
+            data = fetched.get()
+            if data is done or isinstance(data, Exception):
+                embedded.put(data)
+                return
+            try:
+                embedded.put(embed_so_data(data))
+            except Exception as e:
+                embedded.put(e)
+                return
+
+    workers = [threading.Thread(target=fetch), threading.Thread(target=embed)]
+    for worker in workers:
+        worker.start()
+    try:
+        while True:
+            data = embedded.get()
+            if data is done:
+                break
+            if isinstance(data, Exception):
+                raise data
+            write_so_data(data)
+            if on_page_written:
+                on_page_written(data)
+    finally:
+        stop.set()
+        # Drain the queues so blocked stages can observe the stop flag and exit
+        fetcher, embedder = workers
+        while fetcher.is_alive() or embedder.is_alive():
+            for q in (fetched, embedded):
+                while not q.empty():
+                    q.get_nowait()
+            if not fetcher.is_alive() and fetched.empty():
+                fetched.put(done)
+            time.sleep(0.05)
+
+
+def get_so_checkpoint(tag: str) -> dict:
+    records = neo4j_graph.query(
+        """MATCH (c:ImportCheckpoint {source: 'stackoverflow', tag: $tag})
+        RETURN c.last_activity_date AS last_activity_date""",
+        {"tag": tag},
+    )
+    return records[0] if records else {"last_activity_date": None}
+
+
+def save_so_checkpoint(tag: str, last_activity_date: int) -> None:
+    neo4j_graph.query(
+        """MERGE (c:ImportCheckpoint {source: 'stackoverflow', tag: $tag})
+        SET c.last_activity_date = CASE
+                WHEN c.last_activity_date > $last_activity_date THEN c.last_activity_date
+                ELSE $last_activity_date END,
+            c.updated_at = datetime()""",
+        {"tag": tag, "last_activity_date": last_activity_date},
+    )
+
+
+def so_last_activity(data: dict) -> int:
+    return max(q.get("last_activity_date", q["creation_date"]) for q in data["items"])
+
+
+def sync_so_data(tag: str, num_pages: int, max_in_flight: int = 2) -> None:
+    # Incremental import: only fetch questions created, edited or answered since
+    # the tag's high-water mark. The mark is saved after every written page, so
+    # re-running after a crash picks up where the previous run stopped.
+    # Questions move to the end of the result set when their activity changes
+    # during the sync, so pages are read by keyset (always page 1, min set to the
+    # newest activity fetched so far) instead of by number, which would skip
+    # the questions shifting onto pages already read.
+    min_activity_date = get_so_checkpoint(tag)["last_activity_date"]
+    page = 1
+
+    def next_parameters(data: dict) -> str:
+        nonlocal min_activity_date, page
+        newest = so_last_activity(data)
+        if newest == min_activity_date:
+            # A whole page shares one timestamp, step past it by page number
+            page += 1
+        else:
+            min_activity_date, page = newest, 1
+        return so_sync_parameters(tag, page, min_activity_date)
+
+    def checkpoint(data: dict) -> None:
+        if data["items"]:
+            save_so_checkpoint(tag, so_last_activity(data))
+
+    load_so_pages(
+        tag,
+        1,
+        num_pages,
+        max_in_flight=max_in_flight,
+        parameters=lambda t, p: so_sync_parameters(t, p, min_activity_date),
+        on_page_written=checkpoint,
+        next_parameters=next_parameters,
+    )
+
+
 def load_high_score_so_data() -> None:
     parameters = (
         f"?fromdate=1664150400&order=desc&sort=votes&site=stackoverflow&"
         "filter=!.DK56VBPooplF.)bWW5iOX32Fh1lcCkw1b_Y6Zkb7YD8.ZMhrR5.FRRsR6Z1uK8*Z5wPaONvyII"
     )
-    data = requests.get(so_api_base_url + parameters).json()
+    data = fetch_so_data(parameters)
     insert_so_data(data)
 
 
 def insert_so_data(data: dict) -> None:
-    # Calculate embedding values for questions and answers
+    write_so_data(embed_so_data(data))
+
+
+def text_hash(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def embed_so_data(data: dict) -> dict:
+    # Hashes of the texts that were embedded for questions and answers already in the graph
+    existing = neo4j_graph.query(
+        """UNWIND $questions AS q
+        OPTIONAL MATCH (question:Question {id: q.id})
+        OPTIONAL MATCH (answer:Answer) WHERE answer.id IN q.answers
+        RETURN question.id AS question_id, question.text_hash AS question_hash,
+               collect([answer.id, answer.text_hash]) AS answers""",
+        {
+            "questions": [
+                {"id": q["question_id"], "answers": [a["answer_id"] for a in q["answers"]]}
+                for q in data["items"]
+            ]
+        },
+    )
+    known = {}
+    for record in existing:
+        if record["question_id"] is not None:
+            known[("q", record["question_id"])] = record["question_hash"]
+        for answer_id, answer_hash in record["answers"]:
+            if answer_id is not None:
+                known[("a", answer_id)] = answer_hash
+
+    # Calculate embedding values for new or changed questions and answers in batches
+    texts, targets = [], []
     for q in data["items"]:
         question_text = q["title"] + "\n" + q["body_markdown"]
-        q["embedding"] = embeddings.embed_query(question_text)
+        q["text_hash"] = text_hash(question_text)
+        # Cached RAG answers citing a question are dropped when its text or answers change
+        q["text_changed"] = known.get(("q", q["question_id"])) != q["text_hash"]
+        if q["text_changed"]:
+            texts.append(question_text)
+            targets.append(q)
         for a in q["answers"]:
-            a["embedding"] = embeddings.embed_query(
-                question_text + "\n" + a["body_markdown"]
-            )
+            answer_text = question_text + "\n" + a["body_markdown"]
+            a["text_hash"] = text_hash(answer_text)
+            if known.get(("a", a["answer_id"])) != a["text_hash"]:
+                q["text_changed"] = True
+                texts.append(answer_text)
+                targets.append(a)
+    vectors = embed_in_batches(
+        embeddings,
+        texts,
+        batch_size=embedding_batch_size,
+        max_workers=embedding_max_workers,
+    )
+    for target, vector in zip(targets, vectors):
+        target["embedding"] = vector
+    return data
+
 
+def write_so_data(data: dict) -> None:
     # Cypher, the query language of Neo4j, is used to import the data
     # https://neo4j.com/docs/getting-started/cypher-intro/
     # https://neo4j.com/docs/cypher-cheat-sheet/5/auradb-enterprise/
-    import_query = """
+    # The page is written as separate, batched UNWIND statements: nodes first,
+    # then relationships between them. Rows are sorted by key so concurrent
+    # imports take locks in the same order, and a conflict only retries one
+    # small batch instead of the whole page.
+    questions, answers, tagged, users, asked = [], [], set(), {}, []
+    for q in data["items"]:
+        questions.append(q)
+        for tag in q["tags"]:
+            tagged.add((q["question_id"], tag))
+        owner = q.get("owner", {})
+        if owner.get("user_id") is not None:
+            users.setdefault(owner["user_id"], owner)
+            asked.append({"user_id": owner["user_id"], "question_id": q["question_id"]})
+        for a in q["answers"]:
+            a["question_id"] = q["question_id"]
+            a["user_id"] = a.get("owner", {}).get("user_id", "deleted")
+            users.setdefault(a["user_id"], a.get("owner", {}))
+            answers.append(a)
+
+    questions_query = """
     UNWIND $data AS q
-    MERGE (question:Question {id:q.question_id}) 
-    ON CREATE SET question.title = q.title, question.link = q.link, question.score = q.score,
+    MERGE (question:Question {id:q.question_id})
+    SET question.title = q.title, question.link = q.link, question.score = q.score,
         question.favorite_count = q.favorite_count, question.creation_date = datetime({epochSeconds: q.creation_date}),
-        question.body = q.body_markdown, question.embedding = q.embedding
-    FOREACH (tagName IN q.tags | 
-        MERGE (tag:Tag {name:tagName}) 
-        MERGE (question)-[:TAGGED]->(tag)
-    )
-    FOREACH (a IN q.answers |
-        MERGE (question)<-[:ANSWERS]-(answer:Answer {id:a.answer_id})
-        SET answer.is_accepted = a.is_accepted,
-            answer.score = a.score,
-            answer.creation_date = datetime({epochSeconds:a.creation_date}),
-            answer.body = a.body_markdown,
-            answer.embedding = a.embedding
-        MERGE (answerer:User {id:coalesce(a.owner.user_id, "deleted")}) 
-        ON CREATE SET answerer.display_name = a.owner.display_name,
-                      answerer.reputation= a.owner.reputation
-        MERGE (answer)<-[:PROVIDED]-(answerer)
-    )
-    WITH * WHERE NOT q.owner.user_id IS NULL
-    MERGE (owner:User {id:q.owner.user_id})
-    ON CREATE SET owner.display_name = q.owner.display_name,
-                  owner.reputation = q.owner.reputation
+        question.body = q.body_markdown, question.text_hash = q.text_hash
+    WITH question, q WHERE q.embedding IS NOT NULL
+    CALL db.create.setVectorProperty(question, 'embedding', q.embedding) YIELD node
+    RETURN count(*)
+    """
+    tags_query = """
+    UNWIND $data AS tagName
+    MERGE (:Tag {name:tagName})
+    """
+    tagged_query = """
+    UNWIND $data AS row
+    MATCH (question:Question {id:row.question_id})
+    MATCH (tag:Tag {name:row.tag})
+    MERGE (question)-[:TAGGED]->(tag)
+    """
+    users_query = """
+    UNWIND $data AS u
+    MERGE (user:User {id:u.user_id})
+    ON CREATE SET user.display_name = u.display_name,
+                  user.reputation = u.reputation
+    """
+    answers_query = """
+    UNWIND $data AS a
+    MATCH (question:Question {id:a.question_id})
+    MATCH (answerer:User {id:a.user_id})
+    MERGE (answer:Answer {id:a.answer_id})
+    SET answer.is_accepted = a.is_accepted,
+        answer.score = a.score,
+        answer.creation_date = datetime({epochSeconds:a.creation_date}),
+        answer.body = a.body_markdown,
+        answer.text_hash = a.text_hash
+    MERGE (question)<-[:ANSWERS]-(answer)
+    MERGE (answer)<-[:PROVIDED]-(answerer)
+    WITH answer, a WHERE a.embedding IS NOT NULL
+    CALL db.create.setVectorProperty(answer, 'embedding', a.embedding) YIELD node
+    RETURN count(*)
+    """
+    asked_query = """
+    UNWIND $data AS row
+    MATCH (owner:User {id:row.user_id})
+    MATCH (question:Question {id:row.question_id})
     MERGE (owner)-[:ASKED]->(question)
     """
-    neo4j_graph.query(import_query, {"data": data["items"]})
+    # Runs after the answers stage, so it sees every answer of the page
+    top_answers_query = (
+        """
+    UNWIND $data AS id
+    MATCH (question:Question {id:id})
+    """
+        + top_answers_subquery
+    )
+    stages = [
+        ("questions", questions_query, sorted(questions, key=lambda q: q["question_id"])),
+        ("tags", tags_query, sorted({tag for _, tag in tagged})),
+        ("tagged", tagged_query, [{"question_id": q, "tag": t} for q, t in sorted(tagged)]),
+        (
+            "users",
+            users_query,
+            [
+                {
+                    "user_id": user_id,
+                    "display_name": owner.get("display_name"),
+                    "reputation": owner.get("reputation"),
+                }
+                for user_id, owner in sorted(users.items(), key=lambda u: str(u[0]))
+            ],
+        ),
+        ("answers", answers_query, sorted(answers, key=lambda a: a["answer_id"])),
+        ("asked", asked_query, sorted(asked, key=lambda r: r["question_id"])),
+        ("top_answers", top_answers_query, sorted(q["question_id"] for q in questions)),
+    ]
+    for name, query, rows in stages:
+        started = time.perf_counter()
+        run_in_batches(neo4j_graph, query, rows, neo4j_write_batch_size)
+        logger.info(
+            f"Import {name}: {len(rows)} rows in {time.perf_counter() - started:.2f}s"
+        )
+    invalidate_answer_cache(
+        neo4j_graph, [q["question_id"] for q in questions if q["text_changed"]]
+    )
+    # Lets the bots know their cached ticket examples may be outdated
+    neo4j_graph.query(
+        "MERGE (s:ImportState {source: 'stackoverflow'}) SET s.updated_at = datetime()"
+    )
+    if isinstance(embeddings, CachedEmbeddings):
+        logger.info(f"Embedding cache: {embeddings.stats()}")
 
 
 # Streamlit
@@ -123,12 +466,25 @@ def render_page():
 
     user_input = get_tag()
     num_pages, start_page = get_pages()
+    incremental = st.checkbox(
+        "Only import questions that are new or changed since the last import of this tag",
+        help="Start page is ignored, the import resumes from the tag's last checkpoint.",
+    )
 
     if st.button("Import", type="primary"):
         with st.spinner("Loading... This might take a minute or two."):
             try:
-                for page in range(1, num_pages + 1):
-                    load_so_data(user_input, start_page + (page - 1))
+                if incremental:
+                    sync_so_data(
+                        user_input, num_pages, max_in_flight=so_max_in_flight_pages
+                    )
+                else:
+                    load_so_pages(
+                        user_input,
+                        start_page,
+                        num_pages,
+                        max_in_flight=so_max_in_flight_pages,
+                    )
                 st.success("Import successful", icon="✅")
                 st.caption("Data model")
                 st.image(datamodel_image)
@@ -0,0 +1,81 @@
+import os
+import threading
+
+import neo4j
+from langchain_community.graphs import Neo4jGraph
+
+# Pool settings for the one driver each process shares between its graph and
+# vector store objects
+pool_config = {
+    "max_connection_pool_size": int(os.getenv("NEO4J_MAX_CONNECTION_POOL_SIZE", "50")),
+    "max_connection_lifetime": int(os.getenv("NEO4J_MAX_CONNECTION_LIFETIME", "3600")),
+    "connection_acquisition_timeout": float(
+        os.getenv("NEO4J_CONNECTION_ACQUISITION_TIMEOUT", "60")
+    ),
+    "fetch_size": int(os.getenv("NEO4J_FETCH_SIZE", "1000")),
+}
+
+_lock = threading.Lock()
+_drivers = {}
+_graphs = {}
+
+
+def get_driver(url: str, username: str, password: str) -> neo4j.Driver:
+    key = (url, username)
+    with _lock:
+        if key not in _drivers:
+            _drivers[key] = neo4j.GraphDatabase.driver(
+                url, auth=(username, password), **pool_config
+            )
+        return _drivers[key]
+
+
+def share_driver(store, url: str, username: str, password: str):
+    # Neo4jGraph and Neo4jVector open a driver of their own on construction,
+    # swap it for the shared, pooled one and close the private driver
+    driver = get_driver(url, username, password)
+    if store._driver is not driver:
+        own_driver, store._driver = store._driver, driver
+        own_driver.close()
+    return store
+
+
+def get_graph(url: str, username: str, password: str) -> Neo4jGraph:
+    key = (url, username)
+    with _lock:
+        graph = _graphs.get(key)
+    if graph is None:
+        graph = share_driver(
+            Neo4jGraph(url=url, username=username, password=password),
+            url,
+            username,
+            password,
+        )
+        with _lock:
+            graph = _graphs.setdefault(key, graph)
+    return graph
+
+
+def pool_metrics() -> dict:
+    # The driver has no public pool statistics, read them from its pool and
+    # degrade to an empty report if the internals change
+    metrics = {}
+    with _lock:
+        drivers = dict(_drivers)
+    for (url, username), driver in drivers.items():
+        pool = getattr(driver, "_pool", None)
+        addresses = {}
+        try:
+            for address, connections in list(pool.connections.items()):
+                in_use = pool.in_use_connection_count(address)
+                addresses[str(address)] = {
+                    "in_use": in_use,
+                    "idle": len(connections) - in_use,
+                }
+        except Exception:
+            pass
+        metrics[url] = {
+            "max_connection_pool_size": pool_config["max_connection_pool_size"],
+            "addresses": addresses,
+        }
+    return metrics
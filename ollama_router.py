@@ -0,0 +1,226 @@
+import asyncio
+import os
+import threading
+import time
+import weakref
+from collections import deque
+from typing import Any, List, Optional
+
+import aiohttp
+import requests
+from langchain_core.language_models.chat_models import BaseChatModel
+
+# Requests one Ollama server gets at once before the router queues them, and
+# how often servers are probed
+max_concurrency_per_backend = int(os.getenv("OLLAMA_MAX_CONCURRENCY_PER_BACKEND", "4"))
+health_check_seconds = float(os.getenv("OLLAMA_HEALTH_CHECK_SECONDS", "10"))
+
+# Failures that happen before a server accepted the request, safe to retry
+connection_errors = (
+    requests.exceptions.ConnectionError,
+    aiohttp.ClientConnectorError,
+    ConnectionError,
+)
+
+
+class Backend:
+    def __init__(self, base_url: str, llm, max_concurrency: int):
+        self.base_url = base_url
+        self.llm = llm
+        self.max_concurrency = max_concurrency
+        self.in_flight = 0
+        self.healthy = True
+        self.requests = 0
+        self.failures = 0
+        self.latencies = deque(maxlen=200)
+
+
+class BackendPool:
+    """Least-outstanding-requests balancing over Ollama servers.
+
+    A request goes to the healthy server with the fewest requests in flight
+    that is below its concurrency cap, and waits when all of them are at it.
+    A background thread probes every server, and a server that refused a
+    connection is skipped until a probe succeeds again. The thread only holds
+    a weak reference to the pool and exits once the pool is garbage collected.
+    """
+
+    def __init__(self, backends: List[Backend], health_check_interval: float = 10):
+        self.backends = backends
+        self.waiting = 0
+        self._cond = threading.Condition()
+        # (event loop, asyncio.Event) of each request waiting in aacquire
+        self._async_waiters = []
+        if health_check_interval > 0:
+            threading.Thread(
+                target=BackendPool._check_health,
+                args=(weakref.ref(self), health_check_interval),
+                daemon=True,
+            ).start()
+
+    @staticmethod
+    def _check_health(pool_ref: weakref.ref, interval: float) -> None:
+        while (pool := pool_ref()) is not None:
+            for backend in pool.backends:
+                try:
+                    healthy = (
+                        requests.get(f"{backend.base_url}/api/tags", timeout=2).status_code
+                        == 200
+                    )
+                except requests.RequestException:
+                    healthy = False
+                with pool._cond:
+                    backend.healthy = healthy
+                    pool._notify_all()
+            # Don't keep the pool alive while sleeping
+            del pool
+            time.sleep(interval)
+
+    def _notify_all(self) -> None:
+        # Called with the condition held, wakes sync and async waiters alike
+        self._cond.notify_all()
+        for loop, event in self._async_waiters:
+            try:
+                loop.call_soon_threadsafe(event.set)
+            except RuntimeError:  # Loop already closed
+                pass
+
+    def _pick(self, tried: List[Backend]) -> Optional[Backend]:
+        remaining = [b for b in self.backends if b not in tried]
+        # With no healthy server left, a stale health check is our best bet
+        eligible = [b for b in remaining if b.healthy] or remaining
+        free = [b for b in eligible if b.in_flight < b.max_concurrency]
+        if not free:
+            return None
+        backend = min(free, key=lambda b: (b.in_flight, b.requests))
+        backend.in_flight += 1
+        return backend
+
+    def acquire(self, tried: List[Backend]) -> Backend:
+        with self._cond:
+            self.waiting += 1
+            try:
+                while (backend := self._pick(tried)) is None:
+                    self._cond.wait()
+            finally:
+                self.waiting -= 1
+        return backend
+
+    async def aacquire(self, tried: List[Backend]) -> Backend:
+        # Waiting on the condition would block the event loop, so async callers
+        # wait on an event that release and the health check set from any thread
+        waiter = (asyncio.get_running_loop(), asyncio.Event())
+        with self._cond:
+            self.waiting += 1
+            self._async_waiters.append(waiter)
+        try:
+            while True:
+                with self._cond:
+                    backend = self._pick(tried)
+                    if backend is not None:
+                        return backend
+                    waiter[1].clear()
+                await waiter[1].wait()
+        finally:
+            with self._cond:
+                self.waiting -= 1
+                self._async_waiters.remove(waiter)
+
+    def release(self, backend: Backend, started: float, error=None) -> None:
+        with self._cond:
+            backend.in_flight -= 1
+            backend.requests += 1
+            if error is None:
+                backend.latencies.append(time.perf_counter() - started)
+            else:
+                backend.failures += 1
+                if isinstance(error, connection_errors):
+                    backend.healthy = False
+            self._notify_all()
+
+    def stats(self) -> dict:
+        with self._cond:
+            backends = {}
+            for b in self.backends:
+                latencies = sorted(b.latencies)
+                backends[b.base_url] = {
+                    "healthy": b.healthy,
+                    "in_flight": b.in_flight,
+                    "max_concurrency": b.max_concurrency,
+                    "requests": b.requests,
+                    "failures": b.failures,
+                    "p50_latency_s": latencies[len(latencies) // 2] if latencies else None,
+                    "p95_latency_s": (
+                        latencies[int(len(latencies) * 0.95)] if latencies else None
+                    ),
+                }
+            return {"waiting": self.waiting, "backends": backends}
+
+
+class RoutedChatModel(BaseChatModel):
+    """Chat model that spreads requests over a BackendPool of chat models.
+
+    Requests a server refused are retried on the next one. Other errors
+    (e.g. an unknown model) are raised as they are.
+    """
+
+    pool: Any
+
+    @property
+    def _llm_type(self) -> str:
+        return "routed-ollama"
+
+    @property
+    def num_ctx(self) -> Optional[int]:
+        return getattr(self.pool.backends[0].llm, "num_ctx", None)
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs: Any):
+        tried = []
+        while True:
+            backend = self.pool.acquire(tried)
+            started, error = time.perf_counter(), None
+            try:
+                return backend.llm._generate(
+                    messages, stop=stop, run_manager=run_manager, **kwargs
+                )
+            except Exception as e:
+                error = e
+                tried.append(backend)
+                if not isinstance(e, connection_errors) or len(tried) == len(
+                    self.pool.backends
+                ):
+                    raise
+            finally:
+                self.pool.release(backend, started, error)
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs: Any):
+        tried = []
+        while True:
+            backend = await self.pool.aacquire(tried)
+            started, error = time.perf_counter(), None
+            try:
+                return await backend.llm._agenerate(
+                    messages, stop=stop, run_manager=run_manager, **kwargs
+                )
+            except Exception as e:
+                error = e
+                tried.append(backend)
+                if not isinstance(e, connection_errors) or len(tried) == len(
+                    self.pool.backends
+                ):
+                    raise
+            finally:
+                self.pool.release(backend, started, error)
+
+    def stats(self) -> dict:
+        return self.pool.stats()
+
+
+def route_ollama(backends: dict, max_concurrency: int = 4, health_check_interval: float = 10):
+    """Route between ChatOllama instances keyed by their base url."""
+    return RoutedChatModel(
+        pool=BackendPool(
+            [Backend(url, llm, max_concurrency) for url, llm in backends.items()],
+            health_check_interval=health_check_interval,
+        )
+    )
@@ -0,0 +1,129 @@
+import os
+import threading
+from typing import List
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+# CPU settings of the ONNX Runtime backend, 0 threads lets ONNX Runtime use
+# every physical core
+onnx_threads = int(os.getenv("EMBEDDING_ONNX_THREADS", "0"))
+onnx_batch_size = int(os.getenv("EMBEDDING_ONNX_BATCH_SIZE", "32"))
+
+
+def export_onnx_model(
+    model_name: str, cache_folder: str, quantize: bool = False
+) -> str:
+    """Export a SentenceTransformer's transformer to ONNX, once per cache folder.
+
+    The tokenizer is saved next to the graph, so later runs need neither torch
+    nor sentence-transformers. With quantize the weights are additionally
+    converted to int8 (dynamic quantization).
+    """
+    export_dir = os.path.join(cache_folder, "onnx", model_name)
+    fp32_path = os.path.join(export_dir, "model.onnx")
+    int8_path = os.path.join(export_dir, "model.int8.onnx")
+    if not os.path.exists(fp32_path):
+        import torch
+        from sentence_transformers import SentenceTransformer
+
+        transformer = SentenceTransformer(model_name, cache_folder=cache_folder)[0]
+        os.makedirs(export_dir, exist_ok=True)
+        # Texts are truncated to the length the model was trained with
+        transformer.tokenizer.model_max_length = transformer.max_seq_length
+        transformer.tokenizer.save_pretrained(export_dir)
+        dummy = transformer.tokenizer(["warm up"], return_tensors="pt")
+        input_names = ["input_ids", "attention_mask", "token_type_ids"]
+        # Written under a temporary name so concurrent processes never load a
+        # partially written graph
+        tmp_path = f"{fp32_path}.{os.getpid()}.tmp"
+        torch.onnx.export(
+            transformer.auto_model,
+            tuple(dummy[name] for name in input_names),
+            tmp_path,
+            input_names=input_names,
+            output_names=["last_hidden_state"],
+            dynamic_axes={
+                name: {0: "batch", 1: "sequence"}
+                for name in input_names + ["last_hidden_state"]
+            },
+            opset_version=14,
+        )
+        os.replace(tmp_path, fp32_path)
+    if quantize and not os.path.exists(int8_path):
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+
+        tmp_path = f"{int8_path}.{os.getpid()}.tmp"
+        quantize_dynamic(fp32_path, tmp_path, weight_type=QuantType.QInt8)
+        os.replace(tmp_path, int8_path)
+    return int8_path if quantize else fp32_path
+
+
+class OnnxSentenceEmbeddings(Embeddings):
+    """SentenceTransformer embeddings computed with ONNX Runtime on CPU.
+
+    Reproduces the mean pooling and normalization of the original model, so
+    vectors match SentenceTransformerEmbeddings within float tolerance (fp32)
+    or a cosine similarity close to 1 (int8) and can share one vector index.
+    """
+
+    def __init__(
+        self,
+        model_name: str = "all-MiniLM-L6-v2",
+        cache_folder: str = "/embedding_model",
+        quantize: bool = False,
+        num_threads: int = onnx_threads,
+        batch_size: int = onnx_batch_size,
+    ):
+        import onnxruntime
+        from transformers import AutoTokenizer
+
+        path = export_onnx_model(model_name, cache_folder, quantize=quantize)
+        options = onnxruntime.SessionOptions()
+        options.intra_op_num_threads = num_threads
+        options.graph_optimization_level = (
+            onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        )
+        self.session = onnxruntime.InferenceSession(
+            path, options, providers=["CPUExecutionProvider"]
+        )
+        self.input_names = {i.name for i in self.session.get_inputs()}
+        self.tokenizer = AutoTokenizer.from_pretrained(os.path.dirname(path))
+        self.batch_size = batch_size
+        # Fast tokenizers are not safe to share between threads
+        self._tokenizer_lock = threading.Lock()
+
+    def _embed(self, texts: List[str]) -> np.ndarray:
+        with self._tokenizer_lock:
+            tokens = self.tokenizer(
+                texts, padding=True, truncation=True, return_tensors="np"
+            )
+        inputs = {
+            name: value.astype(np.int64)
+            for name, value in tokens.items()
+            if name in self.input_names
+        }
+        hidden = self.session.run(None, inputs)[0]
+        mask = tokens["attention_mask"][..., None].astype(hidden.dtype)
+        pooled = (hidden * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+        return pooled / np.clip(
+            np.linalg.norm(pooled, axis=1, keepdims=True), 1e-12, None
+        )
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        # Batch texts of similar length together to keep padding low
+        order = sorted(range(len(texts)), key=lambda i: len(texts[i]))
+        vectors = [None] * len(texts)
+        for start in range(0, len(order), self.batch_size):
+            batch = order[start : start + self.batch_size]
+            for i, vector in zip(batch, self._embed([texts[i] for i in batch])):
+                vectors[i] = vector.tolist()
+        return vectors
+
+    def embed_query(self, text: str) -> List[float]:
+        return self._embed([text])[0].tolist()
+
+
+if __name__ == "__main__":
+    # Precompute the ONNX graphs, e.g. into the shared /embedding_model volume
+    export_onnx_model("all-MiniLM-L6-v2", "/embedding_model", quantize=True)
@@ -1,17 +1,25 @@
 import os
+import hashlib
+from typing import Any, List
 
 import streamlit as st
 from langchain.chains import RetrievalQA
-from PyPDF2 import PdfReader
 from langchain.callbacks.base import BaseCallbackHandler
 from langchain.text_splitter import RecursiveCharacterTextSplitter
 from langchain_community.vectorstores import Neo4jVector
+from langchain_core.callbacks import CallbackManagerForRetrieverRun
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+from neo4j_factory import get_graph, share_driver
 from streamlit.logger import get_logger
 from chains import (
     load_embedding_model,
     load_llm,
 )
 
+from embedding_cache import CachedEmbeddings
+from utils import iter_pdf_pages
+
 # load api key lib
 from dotenv import load_dotenv
 
@@ -22,7 +30,18 @@ url = os.getenv("NEO4J_URI")
 username = os.getenv("NEO4J_USERNAME")
 password = os.getenv("NEO4J_PASSWORD")
 ollama_base_url = os.getenv("OLLAMA_BASE_URL")
+ollama_keep_alive = os.getenv("OLLAMA_KEEP_ALIVE")
 embedding_model_name = os.getenv("EMBEDDING_MODEL")
+embedding_cache_path = os.getenv("EMBEDDING_CACHE_PATH")
+embedding_cache_max_bytes = os.getenv("EMBEDDING_CACHE_MAX_BYTES")
+embedding_batch_size = int(os.getenv("EMBEDDING_BATCH_SIZE", "64"))
+pdf_extract_workers = int(os.getenv("PDF_EXTRACT_WORKERS", os.cpu_count() or 1))
+pdf_max_age_days = int(os.getenv("PDF_MAX_AGE_DAYS", "7"))
+pdf_max_total_bytes = int(os.getenv("PDF_MAX_TOTAL_BYTES", str(200 * 1024 * 1024)))
+pdf_search_k = 4
+pdf_search_fetch_k = int(os.getenv("PDF_SEARCH_FETCH_K", "50"))
+pdf_search_max_fetch_k = int(os.getenv("PDF_SEARCH_MAX_FETCH_K", "800"))
+pdf_exact_search_chunks = int(os.getenv("PDF_EXACT_SEARCH_CHUNKS", "500"))
 llm_name = os.getenv("LLM")
 # Remapping for Langchain Neo4j integration
 os.environ["NEO4J_URL"] = url
@@ -30,8 +49,30 @@ os.environ["NEO4J_URL"] = url
 logger = get_logger(__name__)
 
 
-embeddings, dimension = load_embedding_model(
-    embedding_model_name, config={"ollama_base_url": ollama_base_url}, logger=logger
+# Streamlit reruns this script on every interaction, load the embedding model
+# and open its cache once per process
+@st.cache_resource(show_spinner="Loading embedding model...")
+def load_embeddings():
+    return load_embedding_model(
+        embedding_model_name,
+        config={
+            "ollama_base_url": ollama_base_url,
+            "embedding_cache_path": embedding_cache_path,
+            "embedding_cache_max_bytes": embedding_cache_max_bytes,
+        },
+        logger=logger,
+    )
+
+
+embeddings, dimension = load_embeddings()
+
+# if Neo4j is local, you can go to http://localhost:7474/ to browse the database
+neo4j_graph = get_graph(url, username, password)
+neo4j_graph.query(
+    "CREATE INDEX pdf_chunk_doc_id IF NOT EXISTS FOR (c:PdfBotChunk) ON (c.doc_id)"
+)
+neo4j_graph.query(
+    "CREATE CONSTRAINT pdf_document_id IF NOT EXISTS FOR (d:PdfDocument) REQUIRE (d.id) IS UNIQUE"
 )
 
 
@@ -45,48 +86,255 @@ class StreamHandler(BaseCallbackHandler):
         self.container.markdown(self.text)
 
 
-llm = load_llm(llm_name, logger=logger, config={"ollama_base_url": ollama_base_url})
+# Built once per process: with several OLLAMA_BASE_URLs every call would start
+# another router, with its own health check thread
+@st.cache_resource(show_spinner="Loading LLM...")
+def load_chat_llm():
+    return load_llm(
+        llm_name,
+        logger=logger,
+        config={"ollama_base_url": ollama_base_url, "ollama_keep_alive": ollama_keep_alive},
+    )
 
 
-def main():
-    st.header("📄Chat with your pdf file")
+llm = load_chat_llm()
 
-    # upload a your pdf file
-    pdf = st.file_uploader("Upload your PDF", type="pdf")
 
-    if pdf is not None:
-        pdf_reader = PdfReader(pdf)
+def pdf_retrieval_query(doc_id: str) -> str:
+    # The vector index is shared by all uploaded documents: keep only the chunks
+    # of the active document. doc_id is a sha256 hex digest, so it is safe to inline.
+    return f"""
+    WITH node, score WHERE node.doc_id = '{doc_id}'
+    RETURN node.text AS text, score, {{page: node.page, doc_id: node.doc_id}} AS metadata
+    ORDER BY score DESC LIMIT {pdf_search_k}
+    """
 
-        text = ""
-        for page in pdf_reader.pages:
-            text += page.extract_text()
 
-        # langchain_textspliter
-        text_splitter = RecursiveCharacterTextSplitter(
-            chunk_size=1000, chunk_overlap=200, length_function=len
-        )
+class PdfDocumentRetriever(BaseRetriever):
+    """Top chunks of one document among all uploaded PDFs.
+
+    Documents of up to exact_search_chunks chunks are scored exactly: their
+    chunks are found through the doc_id index and compared with the question
+    in Cypher. Larger documents are searched in the vector index shared by all
+    PDFs, which can only be filtered after the nearest neighbours are found, so
+    the search starts with fetch_k neighbours and fetches four times as many,
+    up to max_fetch_k, until the document has pdf_search_k of them.
+    """
+
+    vectorstore: Any
+    doc_id: str
+    chunks: int
+    fetch_k: int = 50
+    max_fetch_k: int = 800
+    exact_search_chunks: int = 500
 
-        chunks = text_splitter.split_text(text=text)
-
-        # Store the chunks part in db (vector)
-        vectorstore = Neo4jVector.from_texts(
-            chunks,
-            url=url,
-            username=username,
-            password=password,
-            embedding=embeddings,
-            index_name="pdf_bot",
-            node_label="PdfBotChunk",
-            pre_delete_collection=True,  # Delete existing PDF data
+    def _exact_search(self, embedding: List[float]) -> List[Document]:
+        # Same score as the cosine vector index, (1 + cosine) / 2
+        records = self.vectorstore.query(
+            """MATCH (node:PdfBotChunk {doc_id: $doc_id})
+            WITH node, reduce(s = [0.0, 0.0], i IN range(0, size($embedding) - 1) |
+                [s[0] + node.embedding[i] * $embedding[i], s[1] + node.embedding[i] ^ 2]
+            ) AS sums
+            WITH node, (1 + sums[0] / (sqrt(sums[1]) * $norm)) / 2 AS score
+            """
+            + pdf_retrieval_query(self.doc_id),
+            params={
+                "doc_id": self.doc_id,
+                "embedding": embedding,
+                "norm": sum(x * x for x in embedding) ** 0.5,
+            },
         )
-        qa = RetrievalQA.from_chain_type(
-            llm=llm, chain_type="stuff", retriever=vectorstore.as_retriever()
+        return [
+            Document(page_content=record["text"], metadata=record["metadata"])
+            for record in records
+        ]
+
+    def _get_relevant_documents(
+        self, query: str, *, run_manager: CallbackManagerForRetrieverRun
+    ) -> List[Document]:
+        embedding = self.vectorstore.embedding.embed_query(query)
+        if self.chunks <= self.exact_search_chunks:
+            return self._exact_search(embedding)
+        fetch_k = self.fetch_k
+        while True:
+            docs = self.vectorstore.similarity_search_by_vector(
+                embedding, k=fetch_k, query=query
+            )
+            if len(docs) >= pdf_search_k or fetch_k >= self.max_fetch_k:
+                return docs
+            fetch_k = min(fetch_k * 4, self.max_fetch_k)
+
+
+def pdf_document_exists(doc_id: str) -> bool:
+    records = neo4j_graph.query(
+        """MATCH (d:PdfDocument {id: $doc_id}) WHERE d.complete
+        SET d.last_used = datetime()
+        RETURN count(d) > 0 AS exists""",
+        {"doc_id": doc_id},
+    )
+    return records[0]["exists"]
+
+
+def delete_pdf_documents(doc_ids: list) -> None:
+    neo4j_graph.query(
+        """UNWIND $doc_ids AS doc_id
+        MATCH (c:PdfBotChunk {doc_id: doc_id})
+        DETACH DELETE c""",
+        {"doc_ids": doc_ids},
+    )
+    neo4j_graph.query(
+        "UNWIND $doc_ids AS doc_id MATCH (d:PdfDocument {id: doc_id}) DETACH DELETE d",
+        {"doc_ids": doc_ids},
+    )
+
+
+def evict_pdf_documents(keep: str) -> None:
+    # Drop documents nobody asked about for pdf_max_age_days, then the least
+    # recently used ones until the stored chunk text fits pdf_max_total_bytes.
+    # The document just loaded (keep) and the most recently used one always
+    # stay, even when one of them alone is larger than the budget.
+    records = neo4j_graph.query(
+        """MATCH (d:PdfDocument)
+        RETURN d.id AS id, d.bytes AS bytes,
+               d.last_used < datetime() - duration({days: $days}) AS expired
+        ORDER BY d.last_used DESC""",
+        {"days": pdf_max_age_days},
+    )
+    evict, total = [], 0
+    for i, record in enumerate(records):
+        total += record["bytes"] or 0
+        if i == 0 or record["id"] == keep:
+            continue
+        if record["expired"] or total > pdf_max_total_bytes:
+            evict.append(record["id"])
+    if evict:
+        logger.info(f"Evicting {len(evict)} PDF documents")
+        delete_pdf_documents(evict)
+
+
+def pdf_qa(vectorstore: Neo4jVector, doc_id: str, chunks: int) -> RetrievalQA:
+    return RetrievalQA.from_chain_type(
+        llm=llm,
+        chain_type="stuff",
+        retriever=PdfDocumentRetriever(
+            vectorstore=vectorstore,
+            doc_id=doc_id,
+            chunks=chunks,
+            fetch_k=pdf_search_fetch_k,
+            max_fetch_k=pdf_search_max_fetch_k,
+            exact_search_chunks=pdf_exact_search_chunks,
+        ),
+    )
+
+
+@st.cache_resource(show_spinner="Reading your PDF file...", max_entries=16)
+def load_pdf_qa(doc_id: str, _pdf) -> RetrievalQA:
+    # Cached per uploaded file, so Streamlit reruns (every question) reuse the
+    # vector store and chain instead of re-extracting and re-embedding the PDF
+    if pdf_document_exists(doc_id):
+        # Uploaded before, possibly by another user: reuse the stored chunks
+        vectorstore = share_driver(
+            Neo4jVector.from_existing_index(
+                embedding=embeddings,
+                url=url,
+                username=username,
+                password=password,
+                index_name="pdf_bot",
+                retrieval_query=pdf_retrieval_query(doc_id),
+            ),
+            url,
+            username,
+            password,
         )
+        chunks = neo4j_graph.query(
+            "MATCH (d:PdfDocument {id: $doc_id}) RETURN d.chunks AS chunks",
+            {"doc_id": doc_id},
+        )[0]["chunks"]
+        return pdf_qa(vectorstore, doc_id, chunks)
+
+    # Leftovers of an interrupted upload of the same document
+    delete_pdf_documents([doc_id])
+
+    # langchain_textspliter
+    text_splitter = RecursiveCharacterTextSplitter(
+        chunk_size=1000, chunk_overlap=200, length_function=len
+    )
+
+    # Pages are extracted in parallel and streamed through the splitter, chunks
+    # are embedded and stored in batches while later pages are still extracted
+    vectorstore = None
+    texts, metadatas = [], []
+    num_chunks, num_bytes = 0, 0
+
+    def store_batch():
+        nonlocal vectorstore, num_chunks, num_bytes
+        if vectorstore is None:
+            # Store the chunks part in db (vector)
+            vectorstore = share_driver(
+                Neo4jVector.from_texts(
+                    texts,
+                    metadatas=metadatas,
+                    url=url,
+                    username=username,
+                    password=password,
+                    embedding=embeddings,
+                    index_name="pdf_bot",
+                    node_label="PdfBotChunk",
+                    retrieval_query=pdf_retrieval_query(doc_id),
+                ),
+                url,
+                username,
+                password,
+            )
+        else:
+            vectorstore.add_texts(texts, metadatas=metadatas)
+        num_chunks += len(texts)
+        num_bytes += sum(len(text) for text in texts)
+        texts.clear()
+        metadatas.clear()
+
+    for page_number, page_text in iter_pdf_pages(
+        _pdf.getvalue(), max_workers=pdf_extract_workers
+    ):
+        for chunk in text_splitter.split_text(text=page_text):
+            texts.append(chunk)
+            metadatas.append({"page": page_number, "doc_id": doc_id})
+        if len(texts) >= embedding_batch_size:
+            store_batch()
+    if texts or vectorstore is None:
+        store_batch()
+
+    neo4j_graph.query(
+        """MERGE (d:PdfDocument {id: $doc_id})
+        SET d.name = $name, d.chunks = $chunks, d.bytes = $bytes,
+            d.uploaded_at = datetime(), d.last_used = datetime(), d.complete = true""",
+        {"doc_id": doc_id, "name": _pdf.name, "chunks": num_chunks, "bytes": num_bytes},
+    )
+    evict_pdf_documents(keep=doc_id)
+    if isinstance(embeddings, CachedEmbeddings):
+        logger.info(f"Embedding cache: {embeddings.stats()}")
+    return pdf_qa(vectorstore, doc_id, num_chunks)
+
+
+def main():
+    st.header("📄Chat with your pdf file")
+
+    # upload a your pdf file
+    pdf = st.file_uploader("Upload your PDF", type="pdf")
+
+    if pdf is not None:
+        doc_id = hashlib.sha256(pdf.getvalue()).hexdigest()
+        qa = load_pdf_qa(doc_id, pdf)
 
         # Accept user questions/query
         query = st.text_input("Ask questions about your PDF file")
 
         if query:
+            # Marks the document as used, and catches a cached chain whose
+            # document was evicted since (e.g. by another user's upload)
+            if not pdf_document_exists(doc_id):
+                load_pdf_qa.clear()
+                qa = load_pdf_qa(doc_id, pdf)
             stream_handler = StreamHandler(st.empty())
             qa.run(query, callbacks=[stream_handler])
 
@@ -1,3 +1,8 @@
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from io import BytesIO
+from typing import Iterator, List, Tuple
+
+
 class BaseLogger:
     def __init__(self) -> None:
         self.info = print
@@ -26,6 +31,67 @@ def extract_title_and_question(input_string):
     return title, question
 
 
+def embed_in_batches(
+    embeddings, texts: List[str], batch_size: int = 64, max_workers: int = 1
+) -> List[List[float]]:
+    # Send texts through embed_documents in fixed size batches instead of
+    # one embed_query round trip per text. Remote providers (Ollama, OpenAI,
+    # Bedrock) can additionally work on several batches concurrently.
+    batch_size = max(int(batch_size), 1)
+    batches = [texts[i : i + batch_size] for i in range(0, len(texts), batch_size)]
+    if max_workers > 1 and len(batches) > 1:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            results = list(executor.map(embeddings.embed_documents, batches))
+    else:
+        results = [embeddings.embed_documents(batch) for batch in batches]
+    return [vector for batch in results for vector in batch]
+
+
+# The document each PDF extraction worker process parsed on start
+worker_pdf_reader = None
+
+
+def init_pdf_worker(pdf_bytes: bytes) -> None:
+    # Runs once per worker process, so the document is sent and parsed once per
+    # worker instead of once per batch of pages
+    from PyPDF2 import PdfReader
+
+    global worker_pdf_reader
+    worker_pdf_reader = PdfReader(BytesIO(pdf_bytes))
+
+
+def extract_pdf_pages(page_numbers: List[int]) -> List[str]:
+    return [worker_pdf_reader.pages[i].extract_text() or "" for i in page_numbers]
+
+
+def iter_pdf_pages(
+    pdf_bytes: bytes, max_workers: int = None, pages_per_task: int = 16
+) -> Iterator[Tuple[int, str]]:
+    # Text extraction is CPU bound, so pages are extracted in a process pool.
+    # Page texts are yielded in order, as soon as their batch is done.
+    from PyPDF2 import PdfReader
+
+    num_pages = len(PdfReader(BytesIO(pdf_bytes)).pages)
+    tasks = [
+        list(range(i, min(i + pages_per_task, num_pages)))
+        for i in range(0, num_pages, pages_per_task)
+    ]
+    with ProcessPoolExecutor(
+        max_workers=max_workers, initializer=init_pdf_worker, initargs=(pdf_bytes,)
+    ) as executor:
+        results = executor.map(extract_pdf_pages, tasks)
+        for page_numbers, texts in zip(tasks, results):
+            for page_number, text in zip(page_numbers, texts):
+                yield page_number + 1, text
+
+
+def run_in_batches(driver, query: str, rows: list, batch_size: int = 50) -> None:
+    # Each batch is its own transaction, passed to the query as $data
+    batch_size = max(int(batch_size), 1)
+    for i in range(0, len(rows), batch_size):
+        driver.query(query, {"data": rows[i : i + batch_size]})
+
+
 def create_vector_index(driver, dimension: int) -> None:
     index_query = "CALL db.index.vector.createNodeIndex('stackoverflow', 'Question', 'embedding', $dimension, 'cosine')"
     try:
@@ -37,6 +103,10 @@ def create_vector_index(driver, dimension: int) -> None:
         driver.query(index_query, {"dimension": dimension})
     except:  # Already exists
         pass
+    # Keyword leg of the hybrid retriever
+    driver.query(
+        "CREATE FULLTEXT INDEX stackoverflow_text IF NOT EXISTS FOR (q:Question) ON EACH [q.title, q.body]"
+    )
 
 
 def create_constraints(driver):
@@ -52,3 +122,46 @@ def create_constraints(driver):
     driver.query(
         "CREATE CONSTRAINT tag_name IF NOT EXISTS FOR (t:Tag) REQUIRE (t.name) IS UNIQUE"
     )
+    driver.query(
+        "CREATE INDEX question_link IF NOT EXISTS FOR (q:Question) ON (q.link)"
+    )
+    driver.query(
+        "CREATE INDEX question_score IF NOT EXISTS FOR (q:Question) ON (q.score)"
+    )
+
+
+# The LLM context of a question is its accepted / best scored two answers. It is
+# stored as question.context_text, so retrieval reads one property per hit
+# instead of sorting all answers of popular questions on every query.
+top_answers_subquery = """
+    CALL { WITH question
+        OPTIONAL MATCH (question)<-[:ANSWERS]-(answer)
+        WITH answer
+        ORDER BY answer.is_accepted DESC, answer.score DESC
+        WITH collect(answer)[..2] as answers
+        RETURN reduce(str='', answer IN answers | str + 
+                '\n### Answer (Accepted: '+ answer.is_accepted +
+                ' Score: ' + answer.score+ '): '+  answer.body + '\n') as answerTexts
+    }
+    SET question.context_text = answerTexts
+"""
+
+
+def backfill_top_answers(driver) -> None:
+    # Questions imported before context_text existed
+    driver.query(
+        """MATCH (question:Question) WHERE question.context_text IS NULL
+        CALL { WITH question"""
+        + top_answers_subquery
+        + "} IN TRANSACTIONS OF 1000 ROWS"
+    )
+
+
+def invalidate_answer_cache(driver, question_ids: list) -> None:
+    # Cached RAG answers citing changed questions must be regenerated
+    driver.query(
+        """UNWIND $ids AS id
+        MATCH (:Question {id: id})<-[:CITES]-(c:CachedAnswer)
+        DETACH DELETE c""",
+        {"ids": question_ids},
+    )